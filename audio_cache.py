@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from shared_state import shared_backend
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", os.path.join("meme_audios", "cache"))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+AUDIO_FILE_ID_TTL = float(os.getenv("AUDIO_FILE_ID_TTL", str(30 * 24 * 3600)))
+# Индекс переписывается целиком, поэтому изменения копятся и сбрасываются не чаще раза в столько секунд
+AUDIO_INDEX_SAVE_DELAY = float(os.getenv("AUDIO_INDEX_SAVE_DELAY", "5"))
+# Недописанный .tmp младше этого может принадлежать соседнему воркеру, который пишет его прямо сейчас
+AUDIO_TMP_MAX_AGE = 3600
+BLOB_NAME = re.compile(r"^[0-9a-f]{40}\.ogg$")
+BLOB_TMP_NAME = re.compile(r"^[0-9a-f]{40}\.ogg\.tmp$")
+
+
+class AudioCache:
+    """Готовые озвучки по ключу (мем, фраза, эффект) с LRU-вытеснением по байтам и file_id Telegram."""
+
+    def __init__(self, cache_dir=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES, backend=None):
+        self.set_cache_dir(cache_dir)
+        self.max_bytes = max_bytes
+        # Папка с файлами общая для воркеров одной машины, индекс у каждого свой; варианты и file_id — через бэкенд
+        self.backend = backend
+        self._entries = None
+        self._by_meme = {}
+        self._dirty = False
+        self._save_handle = None
+        self._save_task = None
+        self._save_lock = asyncio.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.file_id_hits = 0
+        self.evictions = 0
+        self.shared_hits = 0
+
+    def set_cache_dir(self, cache_dir, index_name="index.json"):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, index_name)
+
+    @staticmethod
+    def make_key(meme_id, phrase, effect_name):
+        return hashlib.sha1(f"{meme_id}|{phrase}|{effect_name}".encode("utf-8")).hexdigest()
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._entries = OrderedDict()
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            saved = []
+        except Exception as e:
+            logger.warning(f"Audio cache index unreadable, starting empty: {e}")
+            saved = []
+        for entry in saved:
+            path = self._path(entry["key"])
+            if os.path.exists(path):
+                entry["size"] = os.path.getsize(path)
+                self._entries[entry["key"]] = entry
+                self._index_meme(entry)
+                self.total_bytes += entry["size"]
+        known = {os.path.basename(self._path(key)) for key in self._entries}
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name in known or name.startswith("index"):
+                continue
+            if BLOB_NAME.match(name):
+                # Озвучка соседнего воркера или не попавшая в индекс до падения — берём в свой LRU как самую старую
+                self._adopt(name[:-len(".ogg")], last=False)
+                continue
+            # Удаляем только свои брошенные .tmp: папка может совпасть с чужой (AUDIO_CACHE_DIR=meme_audios)
+            if not BLOB_TMP_NAME.match(name):
+                continue
+            try:
+                if now - os.path.getmtime(path) > AUDIO_TMP_MAX_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+        self._evict()
+        logger.info(f"Audio cache loaded: {len(self._entries)} files, {self.total_bytes} bytes")
+        return self._entries
+
+    def _write_index(self, entries):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def _write_blob(path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_blob(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    async def read(self, path):
+        # Файл могли вытеснить между lookup и отправкой — тогда None, и озвучку делают заново
+        try:
+            return await asyncio.to_thread(self._read_blob, path)
+        except OSError as e:
+            logger.warning(f"Cached audio {path} unreadable: {e}")
+            return None
+
+    def _schedule_save(self):
+        self._dirty = True
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_running_loop().call_later(AUDIO_INDEX_SAVE_DELAY, self._save_soon)
+
+    def _save_soon(self):
+        self._save_handle = None
+        self._save_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        async with self._save_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            # Копии записей: пока поток пишет файл, цикл событий продолжает их менять
+            snapshot = [dict(entry) for entry in self._entries.values()]
+            try:
+                await asyncio.to_thread(self._write_index, snapshot)
+            except Exception as e:
+                self._dirty = True
+                logger.warning(f"Failed to persist audio cache index: {e}")
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.ogg")
+
+    def _adopt(self, key, last=True):
+        try:
+            size = os.path.getsize(self._path(key))
+        except OSError:
+            return None
+        entry = {"key": key, "size": size, "file_id": None, "meme_id": None, "phrase": None, "effect": None}
+        self._entries[key] = entry
+        if not last:
+            self._entries.move_to_end(key, last=False)
+        self.total_bytes += size
+        return entry
+
+    def _index_meme(self, entry):
+        if entry.get("meme_id") is not None:
+            self._by_meme.setdefault(entry["meme_id"], set()).add(entry["key"])
+
+    def _drop(self, entry):
+        self.total_bytes -= entry["size"]
+        keys = self._by_meme.get(entry.get("meme_id"))
+        if keys is not None:
+            keys.discard(entry["key"])
+
+    def _evict(self):
+        evicted = False
+        # Самую свежую запись не трогаем, даже если она одна больше бюджета
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self._drop(entry)
+            self.evictions += 1
+            evicted = True
+            try:
+                os.remove(self._path(key))
+            except OSError as e:
+                logger.warning(f"Failed to delete evicted audio {key}: {e}")
+        return evicted
+
+    async def lookup(self, key):
+        entries = self._load()
+        entry = entries.get(key)
+        if entry is None:
+            shared = await self.backend.get(f"audio:{key}") if self.backend is not None else None
+            if shared is not None:
+                self.hits += 1
+                self.file_id_hits += 1
+                self.shared_hits += 1
+                return {"path": None, "file_id": shared["file_id"]}
+            # Файл мог положить соседний воркер, например прогрев на шарде 0
+            entry = self._adopt(key) if self.backend is not None else None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.shared_hits += 1
+            self._evict()
+            self._schedule_save()
+        if not entry.get("file_id") and not os.path.exists(self._path(key)):
+            self._drop(entry)
+            del entries[key]
+            self.misses += 1
+            return None
+        entries.move_to_end(key)
+        self.hits += 1
+        if entry.get("file_id"):
+            self.file_id_hits += 1
+        return {"path": self._path(key), "file_id": entry.get("file_id")}
+
+    async def store(self, key, data, meme_id=None, phrase=None, effect_name=None):
+        entries = self._load()
+        path = self._path(key)
+        await asyncio.to_thread(self._write_blob, path, data)
+        old = entries.pop(key, None)
+        if old:
+            self._drop(old)
+        size = len(data)
+        entries[key] = {"key": key, "size": size, "file_id": None, "meme_id": meme_id, "phrase": phrase, "effect": effect_name}
+        self._index_meme(entries[key])
+        self.total_bytes += size
+        self._evict()
+        self._schedule_save()
+        if self.backend is not None and meme_id is not None:
+            # Вариант виден всем воркерам сразу, не дожидаясь первой отправки в Telegram
+            variant = {"key": key, "phrase": phrase, "effect": effect_name}
+            await self.backend.set_add(f"audio-variants:{meme_id}", variant, AUDIO_FILE_ID_TTL)
+        return path
+
+    async def variants(self, meme_id):
+        entries = self._load()
+        variants = [
+            {"key": key, "phrase": entries[key]["phrase"], "effect": entries[key]["effect"]}
+            for key in self._by_meme.get(meme_id, ())
+        ]
+        if self.backend is not None:
+            local = {variant["key"] for variant in variants}
+            variants += [variant for variant in await self.backend.set_members(f"audio-variants:{meme_id}") if variant["key"] not in local]
+        return variants
+
+    async def remember_file_id(self, key, file_id):
+        entry = self._load().get(key)
+        if entry is not None and entry.get("file_id") != file_id:
+            entry["file_id"] = file_id
+            self._schedule_save()
+            if self.backend is not None and file_id:
+                await self.backend.set(f"audio:{key}", {"file_id": file_id}, AUDIO_FILE_ID_TTL)
+                if entry.get("meme_id") is not None:
+                    variant = {"key": key, "phrase": entry["phrase"], "effect": entry["effect"]}
+                    await self.backend.set_add(f"audio-variants:{entry['meme_id']}", variant, AUDIO_FILE_ID_TTL)
+
+    async def forget_file_id(self, key):
+        await self.remember_file_id(key, None)
+        if self.backend is not None:
+            await self.backend.delete(f"audio:{key}")
+
+    async def close(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if self._save_task is not None:
+            await asyncio.gather(self._save_task, return_exceptions=True)
+            self._save_task = None
+        await self.flush()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._load()),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "file_id_hits": self.file_id_hits,
+            "evictions": self.evictions,
+            "shared_hits": self.shared_hits,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+audio_cache = AudioCache(backend=shared_backend)
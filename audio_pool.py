@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pydub import AudioSegment
+from sharding import WORKERS
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+# Ядра делятся между процессами-воркерами бота, иначе каждый заведёт по пулу на все ядра
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", str(max(1, (os.cpu_count() or 1) // WORKERS))))
+AUDIO_JOB_TIMEOUT = float(os.getenv("AUDIO_JOB_TIMEOUT", "60"))
+VOICE_BITRATE = os.getenv("VOICE_BITRATE", "48k")
+
+
+def render_voice(tts_data, effect_audio, gain_db):
+    # Выполняется в дочернем процессе: декод mp3 от TTS, эффект в конец, кодирование в OGG/Opus
+    voice = AudioSegment.from_file(io.BytesIO(tts_data), format="mp3")
+    if effect_audio is not None:
+        voice = voice + (effect_audio + gain_db)
+    buffer = io.BytesIO()
+    voice.export(buffer, format="ogg", codec="libopus", bitrate=VOICE_BITRATE, parameters=["-ac", "1"])
+    return buffer.getvalue()
+
+
+class AudioPool:
+    """Пул процессов для тяжёлой работы pydub/ffmpeg, чтобы не держать event loop."""
+
+    def __init__(self, workers=AUDIO_WORKERS, timeout=AUDIO_JOB_TIMEOUT):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._executor = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.resubmitted = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            logger.info(f"Audio pool started with {self.workers} workers")
+        return self._executor
+
+    def _recycle(self):
+        # Зависшую задачу в чужом процессе не прервать — убиваем процессы старого пула целиком.
+        # Остальные его задачи упадут с BrokenProcessPool/отменой, и их ждущие перезапустят их в новом пуле
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def submit(self, fn, *args, timeout=None):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        self.in_flight += 1
+        try:
+            while True:
+                executor = self._get_executor()
+                future = executor.submit(fn, *args)
+                waiter = asyncio.wrap_future(future)
+                try:
+                    # shield: отмена ждущего или таймаут не должны отменять чужие задачи в пуле
+                    result = await asyncio.wait_for(asyncio.shield(waiter), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    # Результат брошенной задачи больше никому не нужен — забираем его, чтобы не шуметь в логах
+                    waiter.add_done_callback(lambda done: done.cancelled() or done.exception())
+                    self.timeouts += 1
+                    if executor is self._executor:
+                        logger.warning(f"Audio job {fn.__name__} timed out, recycling pool")
+                        self._recycle()
+                    raise
+                except (asyncio.CancelledError, BrokenProcessPool) as e:
+                    if not future.cancelled() and not isinstance(e, BrokenProcessPool):
+                        # Отменили самого ждущего: задачу, если она ещё в очереди, тоже снимаем
+                        future.cancel()
+                        waiter.add_done_callback(lambda done: done.cancelled() or done.exception())
+                        self.cancelled += 1
+                        raise
+                    if executor is not self._executor and loop.time() < deadline:
+                        self.resubmitted += 1
+                        continue
+                    self.failed += 1
+                    if executor is self._executor:
+                        logger.error("Audio pool broken, restarting")
+                        self._recycle()
+                    raise BrokenProcessPool(f"audio job {fn.__name__} lost with its worker pool") from None
+                self.completed += 1
+                return result
+        except (asyncio.TimeoutError, asyncio.CancelledError, BrokenProcessPool):
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "resubmitted": self.resubmitted,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            logger.info("Audio pool stopped")
+
+
+audio_pool = AudioPool()
@@ -1,21 +1,114 @@
-from flask import Flask
-from threading import Thread
 import os
+import hmac
+import json
+import asyncio
+import logging
+from aiohttp import web
+from metrics import metrics, profiler
 
-app = Flask(__name__)
+logger = logging.getLogger("MEMEZVUKACH")
 
-@app.route('/')
-def home():
-    return "MemeZvukachBot is alive! 🔥 Check it out on Telegram!"
+WEBHOOK_PATH = "/telegram"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
 
-@app.route('/health')
-def health():
-    return "OK", 200
 
-def run():
-    port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
+class WebServer:
+    """Один aiohttp-сервер в цикле бота: вебхук Telegram, /health, /metrics и /stats."""
 
-def keep_alive():
-    t = Thread(target=run, daemon=True)
-    t.start()
+    def __init__(self, port=None, host="0.0.0.0"):
+        self.port = port if port is not None else int(os.environ.get('PORT', 5000))
+        self.host = host
+        self.secret_token = None
+        self.on_update = None
+        self.stats_providers = {}
+        self.updates = 0
+        self.rejected = 0
+        self._runner = None
+
+    def add_stats(self, name, provider):
+        self.stats_providers[name] = provider
+
+    def set_webhook_handler(self, on_update, secret_token):
+        self.on_update = on_update
+        self.secret_token = secret_token
+
+    def collect_stats(self):
+        stats = {"webhook": {"updates": self.updates, "rejected": self.rejected}}
+        for name, provider in self.stats_providers.items():
+            try:
+                stats[name] = provider()
+            except Exception as e:
+                logger.warning(f"Stats provider '{name}' failed: {e}")
+        return stats
+
+    async def home(self, request):
+        return web.Response(text="MemeZvukachBot is alive! 🔥 Check it out on Telegram!")
+
+    async def health(self, request):
+        return web.Response(text="OK")
+
+    async def metrics(self, request):
+        return web.Response(text=metrics.render(self.collect_stats()), content_type="text/plain", charset="utf-8")
+
+    async def stats(self, request):
+        return web.json_response(self.collect_stats(), dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+    async def profile(self, request):
+        if profiler is None:
+            return web.Response(status=404, text="Profiler disabled, set PROFILER_ENABLED=1")
+        try:
+            seconds = float(request.query.get("seconds", "10"))
+        except ValueError:
+            return web.Response(status=400)
+        # Сэмплер живёт в отдельном потоке и смотрит на стек цикла событий
+        stacks = await asyncio.to_thread(profiler.sample, seconds)
+        return web.Response(text=profiler.folded(stacks))
+
+    async def webhook(self, request):
+        if self.on_update is None:
+            return web.Response(status=404)
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            self.rejected += 1
+            logger.warning(f"Rejected webhook call from {request.remote}: bad secret token")
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            self.rejected += 1
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            self.rejected += 1
+            return web.Response(status=400)
+        # Только кладём апдейт в очередь: Telegram получает 200 сразу, обработка идёт в фоне
+        try:
+            await self.on_update(data)
+        except (KeyError, TypeError, ValueError) as e:
+            self.rejected += 1
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return web.Response(status=400)
+        self.updates += 1
+        return web.Response()
+
+    async def start(self):
+        if self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/", self.home)
+        app.router.add_get("/health", self.health)
+        app.router.add_get("/metrics", self.metrics)
+        app.router.add_get("/stats", self.stats)
+        app.router.add_get("/profile", self.profile)
+        app.router.add_post(WEBHOOK_PATH, self.webhook)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Web server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+web_server = WebServer()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Локальные заглушки внешних сервисов для нагрузочных прогонов без сети.
+
+Каждый сервис отвечает с задержкой latency * uniform(0.5, 1.5) и падает с вероятностью failure_rate.
+"""
+import io
+import json
+import time
+import random
+import asyncio
+import urllib.parse
+from collections import Counter
+from types import SimpleNamespace
+
+import httpx
+from telegram.request import BaseRequest
+
+SERVICES = ("telegram", "tts", "sounds", "llm", "google")
+DEFAULT_LATENCY = {"telegram": 0.05, "tts": 0.8, "sounds": 0.1, "llm": 0.5, "google": 0.3}
+SOUND_HOSTS = ("myinstants.com", "soundboardguy.com")
+VALID_EMOJIS = ["🦈", "🐊", "🦁", "🦄", "🎸"]
+
+
+def fake_mp3(milliseconds):
+    # С ffmpeg — настоящий mp3, чтобы микширование в audio_pool шло по боевому пути
+    try:
+        from pydub import AudioSegment
+        buffer = io.BytesIO()
+        AudioSegment.silent(duration=milliseconds).export(buffer, format="mp3")
+        return buffer.getvalue(), True
+    except Exception:
+        return bytes(random.getrandbits(8) for _ in range(milliseconds * 4)), False
+
+
+class FakeServices:
+    """Общие настройки и счётчики всех заглушек."""
+
+    def __init__(self, latency=None, failure_rate=0.0, seed=1):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.failures = Counter()
+        self.tts_mp3, self.real_audio = fake_mp3(3000)
+        self.sound_mp3, _ = fake_mp3(500)
+
+    async def respond(self, service):
+        self.calls[service] += 1
+        await asyncio.sleep(self.latency[service] * self.random.uniform(0.5, 1.5))
+        if self.random.random() < self.failure_rate:
+            self.failures[service] += 1
+            return False
+        return True
+
+    def transport(self):
+        return httpx.MockTransport(self._handle_http)
+
+    async def _handle_http(self, request):
+        host = request.url.host
+        if host == "text.pollinations.ai":
+            if not await self.respond("tts"):
+                return httpx.Response(503)
+            return httpx.Response(200, content=self.tts_mp3, headers={"Content-Type": "audio/mpeg"})
+        if host.endswith(SOUND_HOSTS):
+            if not await self.respond("sounds"):
+                return httpx.Response(503)
+            return httpx.Response(200, content=self.sound_mp3, headers={"Content-Type": "audio/mpeg"})
+        if host == "www.google.com":
+            if not await self.respond("google"):
+                return httpx.Response(429)
+            query = urllib.parse.quote(request.url.params.get("q", ""))
+            html = '<img src="/logo.png">' + "".join(f'<img src="https://images.example/{query}/{i}.jpg">' for i in range(3))
+            return httpx.Response(200, text=html)
+        return httpx.Response(404)
+
+    def llm(self):
+        return FakeLLM(self)
+
+    def telegram(self):
+        return FakeTelegram(self)
+
+
+class FakeLLM:
+    """Подменяет g4f AsyncClient: client.chat.completions.create(...)."""
+
+    def __init__(self, services):
+        self.services = services
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, provider, messages, web_search=False, stream=False):
+        if not await self.services.respond("llm"):
+            raise RuntimeError("fake DeepInfra: 502 Bad Gateway")
+        system, user = messages[0]["content"], messages[-1]["content"]
+        if "эмодзи" in system:
+            content = self.services.random.choice(VALID_EMOJIS)
+        elif "фото" in system:
+            content = f"https://photos.example/{urllib.parse.quote(user)}.jpg"
+        else:
+            content = "\n".join(f"{i + 1}. Фраза {self.services.random.getrandbits(32):08x} 🦈" for i in range(25))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class FakeTelegram(BaseRequest):
+    """Bot API в памяти: отвечает на то, что зовёт бот, и запоминает отправленное."""
+
+    def __init__(self, services):
+        self.services = services
+        self.sent = Counter()
+        self._message_id = 0
+        self._file_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, parameters):
+        self._message_id += 1
+        chat_id = int(parameters.get("chat_id", 0))
+        return {"message_id": self._message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data is not None else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+        if not await self.services.respond("telegram"):
+            return 500, json.dumps({"ok": False, "error_code": 500, "description": "Internal Server Error"}).encode()
+        self.sent[endpoint] += 1
+        if endpoint in ("sendMessage", "sendVoice"):
+            result = self._message(parameters)
+            if endpoint == "sendVoice":
+                self._file_id += 1
+                result["voice"] = {"file_id": f"voice{self._file_id}", "file_unique_id": f"u{self._file_id}", "duration": 3}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Нагрузочный прогон handle_text/random_meme целиком, без сети.
+
+Бот собирается как в main(): Application + ChatUpdateProcessor, но Bot API, TTS, звуки,
+DeepInfra и Google Images подменены заглушками из fakes.py. Все кэши пишутся во временную папку.
+
+Запуск из корня репозитория:
+    python benchmarks/load_bench.py [--users 2000] [--requests 2] [--failure-rate 0.05] [--latency-scale 0.2]
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import warnings
+import tempfile
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+QUERIES = [
+    "тралалеро", "tralalero tralala", "bombardiro krokodilo", "бомбардиро", "крокодил бомбардировщик",
+    "акула в кроссовках nike", "тунг тунг", "cappuccino assassino", "балерина", "жираф",
+    "tung tung sahur", "porca vacca", "совсем не мем qwerty",
+]
+RANDOM_SHARE = 0.3
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else 0.0
+
+
+def isolate(tmp):
+    # До импорта main: синглтоны кэшей читают пути из окружения при импорте
+    os.environ.update({
+        "MEMES_JSON": os.path.join(ROOT, "memes.json"),
+        "AUDIO_CACHE_DIR": os.path.join(tmp, "cache"),
+        "SOUND_CACHE_DIR": os.path.join(tmp, "sounds"),
+        "LOOKUP_CACHE_PATH": os.path.join(tmp, "lookups.json"),
+        "USER_STATE_DB": os.path.join(tmp, "user_state.sqlite3"),
+    })
+    # Меряем сам бот, а не лимиты провайдеров; их можно задать явно через окружение
+    for name in ("UPSTREAM_TTS_PER_MINUTE", "UPSTREAM_LLM_PER_MINUTE", "UPSTREAM_GOOGLE_PER_MINUTE"):
+        os.environ.setdefault(name, "0")
+    os.chdir(tmp)
+
+
+async def run(args):
+    import httpx
+    from telegram import Update
+    from telegram.ext import Application, CommandHandler, MessageHandler, filters
+    import main
+    from http_pool import http_pool
+    from update_queue import ChatUpdateProcessor
+    from fakes import FakeServices, DEFAULT_LATENCY
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+        logging.getLogger("MEMEZVUKACH").setLevel(logging.CRITICAL)
+        warnings.filterwarnings("ignore", module="pydub")
+
+    services = FakeServices(
+        latency={name: value * args.latency_scale for name, value in DEFAULT_LATENCY.items()},
+        failure_rate=args.failure_rate,
+    )
+    if not services.real_audio:
+        print("ffmpeg not found: TTS returns junk bytes, voice mixing falls back to plain mp3")
+    http_pool._client = httpx.AsyncClient(transport=services.transport(), follow_redirects=True)
+    main.async_client = services.llm()
+    telegram = services.telegram()
+
+    app = (
+        Application.builder().token("1:bench").request(telegram).get_updates_request(telegram)
+        .concurrent_updates(ChatUpdateProcessor()).build()
+    )
+    started_at = {}
+    latencies = {"handle_text": [], "random_meme": []}
+
+    def timed(handler, name):
+        async def wrapper(update, context):
+            try:
+                await handler(update, context)
+            finally:
+                latencies[name].append(time.monotonic() - started_at.pop(update.update_id))
+        return wrapper
+
+    errors = []
+
+    async def count_error(update, context):
+        errors.append(context.error)
+
+    app.add_handler(CommandHandler("random", timed(main.random_meme, "random_meme")))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(main.handle_text, "handle_text")))
+    app.add_error_handler(count_error)
+
+    rng = random.Random(args.seed)
+    updates = []
+    for n in range(args.users * args.requests):
+        user_id = 1000 + n % args.users
+        text = "/random" if rng.random() < RANDOM_SHARE else rng.choice(QUERIES)
+        message = {"message_id": n + 1, "date": 0, "text": text, "chat": {"id": user_id, "type": "private"},
+                   "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        updates.append({"update_id": n + 1, "message": message})
+
+    await main.catalog.start()
+    async with app:
+        await app.start()
+        await main.sound_cache.warm(main.MEME_SOUNDS)
+        main.phrase_pool.start()
+        if args.prewarm:
+            main.prewarmer.start()
+        started = time.monotonic()
+        interval = 1.0 / args.rate if args.rate else 0.0
+        for data in updates:
+            update = Update.de_json(data, app.bot)
+            started_at[update.update_id] = time.monotonic()
+            await app.update_queue.put(update)
+            if interval:
+                await asyncio.sleep(interval)
+        # Отброшенные и склеенные процессором апдейты хендлер не увидит: ждём, пока всё затихнет
+        idle_checks = 0
+        while started_at and idle_checks < 3:
+            await asyncio.sleep(0.05)
+            stats = app.update_processor.stats()
+            idle = app.update_queue.empty() and stats["waiting"] == 0 and stats["active"] == 0
+            idle_checks = idle_checks + 1 if idle else 0
+        elapsed = time.monotonic() - started
+        await app.stop()
+    await main.shutdown(app)
+
+    handled = sum(len(values) for values in latencies.values())
+    print(f"\n{len(updates)} updates from {args.users} users in {elapsed:.1f}s, {handled / elapsed:.1f} handled/s")
+    print(f"{'handler':>12} {'count':>7} {'p50 s':>8} {'p99 s':>8} {'mean s':>8} {'max s':>8}")
+    for name, values in latencies.items():
+        if values:
+            print(f"{name:>12} {len(values):>7} {percentile(values, 0.5):>8.2f} {percentile(values, 0.99):>8.2f} "
+                  f"{statistics.fmean(values):>8.2f} {max(values):>8.2f}")
+    print(f"\nnot handled (dropped or coalesced): {len(started_at)}, handlers raised: {len(errors)}")
+    print(f"update processor: {app.update_processor.stats()}")
+    print(f"fake calls: {dict(services.calls)}, injected failures: {dict(services.failures)}")
+    print(f"sent to telegram: {dict(telegram.sent)}")
+    print(f"audio cache: {main.audio_cache.stats()}")
+    print(f"lookup cache: {main.lookup_cache.stats()}")
+    print(f"phrase pool: {main.phrase_pool.stats()}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=2, help="запросов на юзера")
+    parser.add_argument("--rate", type=float, default=0.0, help="апдейтов в секунду, 0 — все сразу")
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    parser.add_argument("--latency-scale", type=float, default=0.2, help="множитель задержек заглушек")
+    parser.add_argument("--prewarm", action="store_true", help="запустить прогрев кэшей")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        isolate(tmp)
+        asyncio.run(run(arguments))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Сравнение триграммного индекса с прежним поиском через difflib.
+
+Запуск из корня репозитория: python benchmarks/search_bench.py [размеры каталога...]
+"""
+import os
+import sys
+import json
+import time
+import random
+import difflib
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_index import MemeSearchIndex
+
+QUERIES = [
+    "тралалеро", "tralalero tralala", "bombardiro krokodilo", "бомбардиро", "крокодил бомбардировщик",
+    "акула в кроссовках nike", "тунг тунг", "cappuccino assassino", "балерина", "жираф", "бобр",
+    "tung tung sahur", "корова в космосе", "porca vacca",
+]
+
+
+def difflib_search(query, memes):
+    # Прежний путь из handle_text: имя через get_close_matches, затем перебор описаний
+    query = query.lower().strip()
+    names = [m["name"].lower() for m in memes]
+    closest = difflib.get_close_matches(query, names, n=1, cutoff=0.3)
+    meme = next((m for m in memes if m["name"].lower() == closest[0]), None) if closest else None
+    if not meme or difflib.SequenceMatcher(None, query, meme["name"].lower()).ratio() < 0.6:
+        best_match = None
+        best_ratio = 0.0
+        for candidate in memes:
+            ratio = difflib.SequenceMatcher(None, query, candidate["description"].lower()).ratio()
+            if ratio > best_ratio and ratio > 0.5:
+                best_ratio = ratio
+                best_match = candidate
+        meme = best_match or meme
+    return meme
+
+
+def synthetic_catalog(memes, size, seed=42):
+    # Настоящие мемы + уникальные синтетические: имена из слогов, описания из слов реального каталога
+    rng = random.Random(seed)
+    words = sorted({word for meme in memes for word in meme["description"].split()})
+    syllables = [c + v for c in "бвгджзклмнпрстфхцчш" for v in "аеиоуя"]
+    catalog = list(memes[:size])
+    while len(catalog) < size:
+        name = " ".join("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).capitalize() for _ in range(2))
+        catalog.append({
+            "id": len(catalog) + 1,
+            "name": name,
+            "name_english": name,
+            "description": " ".join(rng.sample(words, 25) + [name.split()[0].lower()]),
+            "slogan": "",
+            "tiktok_phrase": "",
+        })
+    return catalog
+
+
+def time_queries(search, rounds):
+    samples = []
+    for _ in range(rounds):
+        for query in QUERIES:
+            started = time.perf_counter()
+            search(query)
+            samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+def main(sizes):
+    with open("memes.json", "r", encoding="utf-8") as f:
+        memes = json.load(f)["memes"]
+    print(f"{'memes':>7} {'build ms':>9} {'index p50':>10} {'index p99':>10} {'difflib p50':>12} {'difflib p99':>12}")
+    for size in sizes:
+        catalog = synthetic_catalog(memes, size)
+        started = time.perf_counter()
+        index = MemeSearchIndex(catalog)
+        build_ms = (time.perf_counter() - started) * 1000
+        index_p50, index_p99 = time_queries(lambda q: index.search(q, k=5), rounds=20)
+        difflib_p50, difflib_p99 = time_queries(lambda q: difflib_search(q, catalog), rounds=1 if size > 1000 else 3)
+        print(f"{size:>7} {build_ms:>9.1f} {index_p50:>10.3f} {index_p99:>10.3f} {difflib_p50:>12.3f} {difflib_p99:>12.3f}")
+
+    index = MemeSearchIndex(memes)
+    print("\nTop match on the real catalog (index vs difflib):")
+    for query in QUERIES:
+        matches = index.search(query, k=1)
+        indexed = matches[0][0]["name"] if matches else "-"
+        old = difflib_search(query, memes)
+        print(f"  {query!r:32} {indexed:28} {old['name'] if old else '-'}")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [35, 1000, 10000, 30000])
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Память на историю фраз: прежний dict списков против UserStateStore.
+
+Запуск из корня репозитория: python benchmarks/user_state_bench.py [число юзеров...]
+"""
+import os
+import sys
+import asyncio
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_state import UserStateStore
+
+PHRASES_PER_USER = 20
+
+
+def phrase(user_id, i):
+    # Фразы от LLM у разных юзеров почти всегда разные строки
+    return f"Мемная фраза #{i} для юзера {user_id}! 🦈"
+
+
+def dict_of_lists(users):
+    history = {}
+    for user_id in range(users):
+        user_phrases = history.setdefault(user_id, [])
+        for i in range(PHRASES_PER_USER + 5):
+            user_phrases.append(phrase(user_id, i))
+            if len(user_phrases) > 20:
+                user_phrases.pop(0)
+    return history
+
+
+async def store(users, max_users, db_path):
+    # Сброс в SQLite уходит в поток, поэтому гоняем внутри цикла событий, как в боте
+    state = UserStateStore(history_size=PHRASES_PER_USER, max_users=max_users, db_path=db_path)
+    for user_id in range(users):
+        for i in range(PHRASES_PER_USER + 5):
+            state.remember(user_id, phrase(user_id, i))
+    await asyncio.gather(*list(state._pending_writes))
+    return state
+
+
+async def check(state):
+    await state.load(0)
+    assert state.has_heard(0, phrase(0, PHRASES_PER_USER + 4))
+    await state.close()
+
+
+def measure(build):
+    tracemalloc.start()
+    result = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current / 1024 / 1024
+
+
+def main(sizes):
+    # capped: в памяти не больше 10000 юзеров, остальные в SQLite
+    print(f"{'users':>9} {'dict MB':>9} {'store MB':>9} {'capped MB':>10}")
+    for users in sizes:
+        _, dict_mb = measure(lambda: dict_of_lists(users))
+        _, store_mb = measure(lambda: asyncio.run(store(users, max_users=users, db_path="")))
+        with tempfile.TemporaryDirectory() as tmp:
+            capped, capped_mb = measure(lambda: asyncio.run(store(users, max_users=10000, db_path=os.path.join(tmp, "state.sqlite3"))))
+            asyncio.run(check(capped))
+        print(f"{users:>9} {dict_mb:>9.1f} {store_mb:>9.1f} {capped_mb:>10.1f}")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import asyncio
+import logging
+from search_index import MemeSearchIndex, normalize
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+MEMES_JSON = os.getenv("MEMES_JSON", "memes.json")
+CATALOG_WATCH_INTERVAL = float(os.getenv("CATALOG_WATCH_INTERVAL", "5"))
+# Больше этого размера файл читается потоково через ijson, если он установлен
+CATALOG_STREAM_BYTES = 4 * 1024 * 1024
+# Перечитанный файл, где отброшена большая доля записей, считаем битым и оставляем прежнюю версию
+CATALOG_MAX_REJECTED_SHARE = float(os.getenv("CATALOG_MAX_REJECTED_SHARE", "0.5"))
+MEME_FIELDS = ("id", "name", "name_english", "description", "slogan", "tiktok_phrase")
+REQUIRED_FIELDS = ("name", "name_english")
+
+
+class Meme:
+    """Запись каталога: слоты вместо dict, но с доступом meme["name"] как раньше."""
+
+    __slots__ = MEME_FIELDS
+
+    def __init__(self, id, name, name_english, description="", slogan="", tiktok_phrase=""):
+        self.id = id
+        self.name = name
+        self.name_english = name_english
+        self.description = description
+        self.slogan = slogan
+        self.tiktok_phrase = tiktok_phrase
+
+    def __getitem__(self, field):
+        if field not in MEME_FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default) if field in MEME_FIELDS else default
+
+    def __repr__(self):
+        return f"Meme({self.id!r}, {self.name_english!r})"
+
+
+def validate_meme(raw):
+    if not isinstance(raw, dict):
+        raise ValueError("entry is not an object")
+    meme_id = raw.get("id")
+    if isinstance(meme_id, bool) or not isinstance(meme_id, int):
+        raise ValueError(f"bad id {meme_id!r}")
+    fields = {}
+    for field in MEME_FIELDS[1:]:
+        value = raw.get(field, "")
+        if not isinstance(value, str):
+            raise ValueError(f"meme {meme_id}: field '{field}' is not a string")
+        fields[field] = value.strip()
+    for field in REQUIRED_FIELDS:
+        if not fields[field]:
+            raise ValueError(f"meme {meme_id}: field '{field}' is empty")
+    # Имена повторяются в индексах и логах — держим одну копию строки
+    fields["name"] = sys.intern(fields["name"])
+    fields["name_english"] = sys.intern(fields["name_english"])
+    return Meme(meme_id, **fields)
+
+
+def iter_raw_memes(path):
+    with open(path, "rb") as f:
+        if ijson is not None and os.fstat(f.fileno()).st_size > CATALOG_STREAM_BYTES:
+            yield from ijson.items(f, "memes.item")
+            return
+        data = json.load(f)
+    if not isinstance(data, dict) or not isinstance(data.get("memes"), list):
+        raise ValueError("expected an object with a 'memes' list")
+    yield from data["memes"]
+
+
+class CatalogSnapshot:
+    """Неизменяемая версия каталога; заменяется целиком одной ссылкой."""
+
+    __slots__ = ("memes", "by_id", "by_name", "mtime", "_index")
+
+    def __init__(self, memes, mtime=None):
+        self.memes = tuple(memes)
+        self.by_id = {meme.id: meme for meme in self.memes}
+        self.by_name = {}
+        for meme in self.memes:
+            for name in (meme.name, meme.name_english):
+                self.by_name.setdefault(normalize(name), meme)
+        self.mtime = mtime
+        self._index = None
+
+    def index(self):
+        if self._index is None:
+            self._index = MemeSearchIndex(self.memes)
+        return self._index
+
+
+class MemeCatalog:
+    """Каталог мемов: валидация, индексы по id и имени, перечитывание файла на лету."""
+
+    def __init__(self, path=MEMES_JSON, watch_interval=CATALOG_WATCH_INTERVAL):
+        self.path = path
+        self.watch_interval = watch_interval
+        self._snapshot = None
+        self._task = None
+        self.reloads = 0
+        self.reload_errors = 0
+        self.rejected = 0
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _build(self, mtime, eager_index):
+        memes = []
+        seen = set()
+        rejected = 0
+        for raw in iter_raw_memes(self.path):
+            try:
+                meme = validate_meme(raw)
+                if meme.id in seen:
+                    raise ValueError(f"duplicate id {meme.id}")
+            except ValueError as e:
+                rejected += 1
+                logger.warning(f"Skipping meme entry: {e}")
+                continue
+            seen.add(meme.id)
+            memes.append(meme)
+        if self._snapshot is not None and self._snapshot.memes:
+            total = len(memes) + rejected
+            if not memes or rejected / total > CATALOG_MAX_REJECTED_SHARE:
+                raise ValueError(f"{rejected} of {total} entries rejected, keeping the previous catalog")
+        snapshot = CatalogSnapshot(memes, mtime)
+        if eager_index:
+            snapshot.index()
+        self.rejected = rejected
+        return snapshot
+
+    def _reload(self, eager_index):
+        mtime = self._mtime()
+        if mtime is None:
+            if self._snapshot is None:
+                logger.error(f"Memes file {self.path} not found")
+                self._snapshot = CatalogSnapshot((), None)
+            return None
+        try:
+            snapshot = self._build(mtime, eager_index)
+        except Exception as e:
+            # Битый файл не должен оставить бота без мемов — держим прежнюю версию
+            self.reload_errors += 1
+            logger.error(f"Load memes error: {e}")
+            if self._snapshot is None:
+                self._snapshot = CatalogSnapshot((), mtime)
+            else:
+                self._snapshot.mtime = mtime
+            return None
+        return snapshot
+
+    def snapshot(self):
+        if self._snapshot is None:
+            snapshot = self._reload(eager_index=False)
+            if snapshot is not None:
+                self._snapshot = snapshot
+                logger.info(f"Meme catalog loaded: {len(snapshot.memes)} memes, {self.rejected} rejected")
+        return self._snapshot
+
+    def memes(self):
+        return self.snapshot().memes
+
+    def by_name(self, name):
+        return self.snapshot().by_name.get(normalize(name))
+
+    def search(self, query, k=5, min_score=0.0):
+        return self.snapshot().index().search(query, k=k, min_score=min_score)
+
+    async def check(self):
+        current = self.snapshot()
+        if self._mtime() == current.mtime:
+            return False
+        # Разбор и индекс строятся в потоке, запросы тем временем видят старую версию
+        snapshot = await asyncio.to_thread(self._reload, True)
+        if snapshot is None:
+            return False
+        self._snapshot = snapshot
+        self.reloads += 1
+        logger.info(f"Meme catalog reloaded: {len(snapshot.memes)} memes, {self.rejected} rejected")
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Meme catalog watch error: {e}")
+
+    def stats(self):
+        snapshot = self.snapshot()
+        return {
+            "memes": len(snapshot.memes),
+            "rejected": self.rejected,
+            "reloads": self.reloads,
+            "reload_errors": self.reload_errors,
+        }
+
+    async def start(self):
+        # Первую версию и её индекс строим в потоке до приёма апдейтов, а не в первом хендлере
+        if self._snapshot is None:
+            snapshot = await asyncio.to_thread(self._reload, True)
+            if snapshot is not None:
+                self._snapshot = snapshot
+                logger.info(f"Meme catalog loaded: {len(snapshot.memes)} memes, {self.rejected} rejected")
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+catalog = MemeCatalog()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import os
+import asyncio
+import logging
+import urllib.parse
+import httpx
+from metrics import metrics
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "500"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "100"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", "32"))
+# Свои лимиты для хостов, которые режут частые запросы: TTS pollinations и скрейп Google Images
+HTTP_HOST_LIMITS = {
+    "text.pollinations.ai": int(os.getenv("HTTP_TTS_HOST_LIMIT", "16")),
+    "www.google.com": int(os.getenv("HTTP_GOOGLE_HOST_LIMIT", "4")),
+}
+HTTP_CHUNK_SIZE = 8192
+
+HTTPError = httpx.HTTPError
+
+
+class HttpPool:
+    """Один AsyncClient с keep-alive пулом на весь процесс и лимитом запросов на хост."""
+
+    def __init__(self, per_host_limit=HTTP_PER_HOST_LIMIT, host_limits=None):
+        self.per_host_limit = per_host_limit
+        self.host_limits = dict(host_limits or {})
+        self._client = None
+        self._semaphores = {}
+        self.in_flight = 0
+
+    def _get_client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+                follow_redirects=True,
+            )
+        return self._client
+
+    def _host_semaphore(self, host):
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.host_limits.get(host, self.per_host_limit))
+            self._semaphores[host] = semaphore
+        return semaphore
+
+    async def iter_chunks(self, url, headers=None, timeout=None, max_bytes=None):
+        host = urllib.parse.urlsplit(url).hostname or ""
+        async with self._host_semaphore(host):
+            self.in_flight += 1
+            started = metrics.upstream_started(host)
+            ok = False
+            try:
+                request_timeout = httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT) if timeout else httpx.USE_CLIENT_DEFAULT
+                async with self._get_client().stream("GET", url, headers=headers, timeout=request_timeout) as response:
+                    response.raise_for_status()
+                    received = 0
+                    async for chunk in response.aiter_bytes(HTTP_CHUNK_SIZE):
+                        received += len(chunk)
+                        if max_bytes is not None and received > max_bytes:
+                            raise HTTPError(f"Response from {url} exceeds {max_bytes} bytes")
+                        yield chunk
+                ok = True
+            except (GeneratorExit, asyncio.CancelledError):
+                # Читатель бросил поток или проигравший hedged-запрос отменён — это не ошибка апстрима
+                ok = True
+                raise
+            finally:
+                self.in_flight -= 1
+                metrics.upstream_finished(host, started, ok)
+
+    async def fetch_bytes(self, url, headers=None, timeout=None, max_bytes=None):
+        chunks = []
+        async for chunk in self.iter_chunks(url, headers=headers, timeout=timeout, max_bytes=max_bytes):
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def fetch_text(self, url, headers=None, timeout=None, max_bytes=None, encoding="utf-8"):
+        data = await self.fetch_bytes(url, headers=headers, timeout=timeout, max_bytes=max_bytes)
+        return data.decode(encoding, errors="replace")
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info("HTTP pool closed")
+        self._client = None
+
+
+http_pool = HttpPool(host_limits=HTTP_HOST_LIMITS)
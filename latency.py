@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+REPLY_DEADLINE = float(os.getenv("REPLY_DEADLINE", "25"))
+PHRASE_BUDGET = float(os.getenv("PHRASE_BUDGET", "4"))
+EMOJI_BUDGET = float(os.getenv("EMOJI_BUDGET", "3"))
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+
+class LatencyTracker:
+    """Скользящее окно задержек одного апстрима; по нему считается, когда слать дублирующий запрос."""
+
+    def __init__(self, name, initial_hedge_delay):
+        self.name = name
+        self.initial_hedge_delay = initial_hedge_delay
+        self.samples = deque(maxlen=LATENCY_WINDOW)
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def stats(self):
+        return {
+            "p50": self.percentile(0.5) or 0.0,
+            "p90": self.percentile(0.9) or 0.0,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+    def hedge_delay(self):
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return self.initial_hedge_delay
+        return self.percentile(HEDGE_PERCENTILE)
+
+
+trackers = {}
+
+
+def tracker(name, initial_hedge_delay=5.0):
+    if name not in trackers:
+        trackers[name] = LatencyTracker(name, initial_hedge_delay)
+    return trackers[name]
+
+
+async def hedged(attempts, latency):
+    """Запускает attempts по очереди: следующую — если предыдущая упала или не успела за hedge_delay.
+
+    Возвращает первый успешный результат, остальные попытки отменяет. Попытка считается
+    неудачной, если бросила исключение.
+    """
+    pending = set()
+    errors = []
+    launched = 0
+
+    async def timed(attempt):
+        started = time.monotonic()
+        result = await attempt()
+        latency.record(time.monotonic() - started)
+        return result
+
+    def launch():
+        nonlocal launched
+        task = asyncio.ensure_future(timed(attempts[launched]))
+        task.attempt = launched
+        pending.add(task)
+        launched += 1
+
+    launch()
+    try:
+        while pending:
+            delay = latency.hedge_delay() if launched < len(attempts) else None
+            done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                latency.hedges += 1
+                logger.info(f"Hedging {latency.name}: attempt {launched + 1} after {delay:.1f}s")
+                launch()
+                continue
+            for task in done:
+                pending.discard(task)
+                if task.exception() is None:
+                    if task.attempt > 0:
+                        latency.hedge_wins += 1
+                    return task.result()
+                errors.append(task.exception())
+            if not pending and launched < len(attempts):
+                launch()
+        raise errors[-1]
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def within(awaitable, timeout, fallback=None):
+    """Ждёт не дольше timeout; по истечении или при ошибке — fallback. Сама работа не отменяется."""
+    task = asyncio.ensure_future(awaitable)
+    if task.cancelled() or (timeout <= 0 and not task.done()):
+        return fallback
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), max(timeout, 0))
+    except asyncio.TimeoutError:
+        return fallback
+    except asyncio.CancelledError:
+        # Отменили саму работу, а не того, кто ждёт, — это такой же отказ этапа
+        if task.cancelled():
+            return fallback
+        raise
+    except Exception as e:
+        logger.warning(f"Stage failed, using fallback: {e}")
+        return fallback
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import asyncio
+import logging
+from shared_state import shared_backend
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+LOOKUP_TTL = float(os.getenv("LOOKUP_TTL", str(7 * 24 * 3600)))
+LOOKUP_NEGATIVE_TTL = float(os.getenv("LOOKUP_NEGATIVE_TTL", "3600"))
+LOOKUP_CACHE_PATH = os.getenv("LOOKUP_CACHE_PATH", os.path.join("meme_audios", "lookups.json"))
+# Файл переписывается целиком, поэтому промахи копятся и сбрасываются не чаще раза в столько секунд
+LOOKUP_SAVE_DELAY = float(os.getenv("LOOKUP_SAVE_DELAY", "5"))
+
+
+def meme_key(kind, meme_id):
+    return f"{kind}:{meme_id}"
+
+
+class LookupCache:
+    """Мемоизация ответов LLM по мему: TTL, отрицательный кэш и один запрос на всех ждущих."""
+
+    def __init__(self, path=LOOKUP_CACHE_PATH, ttl=LOOKUP_TTL, negative_ttl=LOOKUP_NEGATIVE_TTL, backend=None):
+        self.path = path
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = None
+        self._inflight = {}
+        self._dirty = False
+        self._save_handle = None
+        self._save_task = None
+        self._save_lock = asyncio.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        self._entries = {}
+        if self.path:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    saved = json.load(f)
+                now = time.time()
+                self._entries = {key: entry for key, entry in saved.items() if entry["expires_at"] > now}
+                logger.info(f"Lookup cache loaded: {len(self._entries)} entries")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"Lookup cache unreadable, starting empty: {e}")
+        return self._entries
+
+    def _write(self, entries):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def _schedule_save(self):
+        if not self.path:
+            return
+        self._dirty = True
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_running_loop().call_later(LOOKUP_SAVE_DELAY, self._save_soon)
+
+    def _save_soon(self):
+        self._save_handle = None
+        self._save_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        async with self._save_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            # Снимок без протухших записей: пока поток пишет файл, цикл событий продолжает менять словарь
+            now = time.time()
+            snapshot = {key: entry for key, entry in self._load().items() if entry["expires_at"] > now}
+            try:
+                await asyncio.to_thread(self._write, snapshot)
+            except Exception as e:
+                self._dirty = True
+                logger.warning(f"Failed to persist lookup cache: {e}")
+
+    async def _entry(self, key):
+        if self.backend is not None:
+            return await self.backend.get(f"lookup:{key}")
+        return self._load().get(key)
+
+    async def is_fresh(self, key, min_remaining=0.0):
+        entry = await self._entry(key)
+        return entry is not None and entry["expires_at"] - time.time() > min_remaining
+
+    async def _fetch(self, key, fetch, is_negative):
+        try:
+            value = await fetch()
+        except Exception:
+            self.errors += 1
+            raise
+        negative = is_negative(value)
+        ttl = self.negative_ttl if negative else self.ttl
+        entry = {"value": value, "negative": negative, "expires_at": time.time() + ttl}
+        if self.backend is not None:
+            # Общий бэкенд: ответ сразу виден всем воркерам, свой файл не ведём
+            await self.backend.set(f"lookup:{key}", entry, ttl)
+        else:
+            self._load()[key] = entry
+            self._schedule_save()
+        return value
+
+    async def get_or_fetch(self, key, fetch, is_negative=lambda value: value is None, min_remaining=0.0):
+        entry = await self._entry(key)
+        if entry is not None and entry["expires_at"] - time.time() > min_remaining:
+            if entry["negative"]:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return entry["value"]
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(key, fetch, is_negative))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shield: отмена одного ждущего не должна рвать запрос остальным
+        return await asyncio.shield(task)
+
+    async def close(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if self._save_task is not None:
+            await asyncio.gather(self._save_task, return_exceptions=True)
+            self._save_task = None
+        await self.flush()
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._load()) if self.backend is None else None,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "in_flight": len(self._inflight),
+            "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        }
+
+
+lookup_cache = LookupCache(backend=shared_backend)
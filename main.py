@@ -1,22 +1,33 @@
 
 
 # -*- coding: utf-8 -*-
-import json
 import random
 import os
 import time
-import requests
 import urllib.parse
-import difflib
 import logging
-import tempfile
 import asyncio
+import signal
+import secrets
 import nest_asyncio
-from contextlib import contextmanager
 from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from pydub import AudioSegment
-from background import keep_alive
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
+from background import web_server, WEBHOOK_PATH
+from http_pool import http_pool, HTTPError
+from sound_cache import sound_cache
+from audio_cache import audio_cache
+from prewarm import Prewarmer
+from catalog import catalog
+from update_queue import ChatUpdateProcessor
+from audio_pool import audio_pool, render_voice
+from lookup_cache import lookup_cache, meme_key
+from user_state import user_state
+from phrase_pool import PhrasePool
+from latency import REPLY_DEADLINE, PHRASE_BUDGET, EMOJI_BUDGET, hedged, tracker, trackers, within
+from metrics import metrics
+from sharding import WORKERS, ShardRouter, feed_updates
+from shared_state import shared_backend, acquire_upstream
+from telegram.error import BadRequest
 import g4f
 from g4f.client import AsyncClient
 from bs4 import BeautifulSoup
@@ -25,8 +36,10 @@ nest_asyncio.apply()
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger("MEMEZVUKACH")
-MEMES_JSON = "memes.json"
 AUDIO_DIR = "meme_audios"
+# Публичный адрес бота: если задан, апдейты приходят вебхуком, иначе — polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 os.makedirs(AUDIO_DIR, exist_ok=True)
 
 MEME_SOUNDS = [
@@ -35,80 +48,67 @@ MEME_SOUNDS = [
     ("anime_wow", "https://myinstants.com/media/sounds/anime-wow.mp3", "https://soundboardguy.com/sounds/anime-wow.mp3")
 ]
 
-user_phrase_history = {}
+FALLBACK_EMOJIS = ["🦈", "🦄", "🦁", "🎸", "🌟"]
+# Фрагменты ответов Bot API, по которым видно, что отвергнут именно file_id
+FILE_ID_ERRORS = ("file identifier", "file reference", "file_id")
+TTS_HEDGE_DELAY = 15.0
+PHOTO_HEDGE_DELAY = 8.0
+# Потолки на ответы апстримов: зависший или раздутый ответ не должен держать память и соединение
+TTS_MAX_BYTES = 10 * 1024 * 1024
+GOOGLE_MAX_BYTES = 2 * 1024 * 1024
+GOOGLE_TIMEOUT = 10.0
+BACKUP_PHRASES = ["Гиппо-тусня! 🦛", "йЙоу чеееееллллл 😜", "Васаб мабой 🎤", "Капучино-вайб! ☕"]
 EMOJIS = {"welcome": "🚀", "help": "🔍", "search": "🔥", "random": "🎲", "audio": "🎸", "loading": "⏳", "error": "😕", "success": "🌟", "meme": "🦄", "vibe": "🦁"}
 MENU_KEYBOARD = ReplyKeyboardMarkup([["🔥 Найти Шедевр", "🎲 Случайный Вайб"], ["🔍 Гид по Мемам"]], resize_keyboard=True)
 
 async_client = AsyncClient()
 PHOTO_PRESET = """Ты бот, который получает название мемного животного из группы итальянских мемов (например, Bombardier Crocodile (Бомбардиро Крокодило)). Найди одно фото этого мема или ссылку на документацию с фото, используя английское и русское название. Верни только одну ссылку. Если ничего не найдено, верни 'Фото не найдено 😕'. Только ссылка или указанный текст."""
 EMOJI_PRESET = """Верни один яркий мемный эмодзи для мема {name_english} ({name}). Только эмодзи, без текста."""
-PHRASE_PRESET = """Сгенерируй мемную фразу в стиле TikTok, до 50 символов, про итальянских мемных животных. Фраза должна быть смешной и энергичной и мемной. Только фраза, без пояснений."""
+PHRASE_BATCH_PRESET = """Сгенерируй {count} разных мемных фраз в стиле TikTok, каждая до 50 символов, про итальянских мемных животных. Фразы должны быть смешными, энергичными и мемными. Каждая фраза с новой строки, без нумерации и пояснений."""
 
-# Кэш мемов
-_memes_cache = None
+SEARCH_MIN_SCORE = 0.4
 
-@contextmanager
-def temp_audio_file():
-    mp3_fd, mp3_path = tempfile.mkstemp(suffix=".mp3", dir=AUDIO_DIR)
-    try:
-        yield mp3_path
-    finally:
-        time.sleep(1)
-        try:
-            os.close(mp3_fd)
-            if os.path.exists(mp3_path):
-                os.remove(mp3_path)
-                logger.info(f"Deleted temp file: {mp3_path}")
-        except Exception as e:
-            logger.warning(f"Failed to delete temp file {mp3_path}: {e}")
-
-async def generate_funny_phrase(user_id):
-    if user_id not in user_phrase_history:
-        user_phrase_history[user_id] = []
-    user_phrases = user_phrase_history[user_id]
-    
-    try:
+async def ask_llm(system, user, web_search=False):
+    # Лимит общий на все воркеры и берётся на каждую попытку, в том числе hedged
+    await acquire_upstream("llm")
+    async with metrics.upstream("deepinfra"):
         response = await async_client.chat.completions.create(
             model="meta-llama-3.1-405b-instruct",
             provider=g4f.Provider.DeepInfra,
-            messages=[{"role": "system", "content": PHRASE_PRESET}, {"role": "user", "content": "Сгенерируй фразу"}],
-            web_search=False,
+            messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
+            web_search=web_search,
             stream=False
         )
-        phrase = response.choices[0].message.content.strip()
-        if phrase and len(phrase) <= 50 and phrase not in user_phrases:
-            logger.info(f"Generated phrase for user {user_id}: [filtered]")
-            user_phrases.append(phrase)
-            if len(user_phrases) > 20:
-                user_phrases.pop(0)
-            return phrase
-        logger.warning(f"Invalid or repeated phrase for user {user_id}: [filtered]")
-    except Exception as e:
-        logger.error(f"Phrase generation error for user {user_id}: {e}")
-    
-    backup_phrases = ["Гиппо-тусня! 🦛", "йЙоу чеееееллллл 😜", "Васаб мабой 🎤", "Капучино-вайб! ☕"]
-    available_phrases = [p for p in backup_phrases if p not in user_phrases]
+    return response.choices[0].message.content
+
+async def generate_phrase_batch(count):
+    return (await ask_llm(PHRASE_BATCH_PRESET.format(count=count), "Сгенерируй фразы")).splitlines()
+
+@metrics.timed("generate_funny_phrase")
+async def generate_funny_phrase(user_id):
+    phrase = phrase_pool.pick(user_id)
+    if phrase:
+        logger.info(f"Picked pooled phrase for user {user_id}: [filtered]")
+        user_state.remember(user_id, phrase)
+        return phrase
+    logger.warning(f"Phrase pool has nothing new for user {user_id} (size {len(phrase_pool)})")
+    return pick_backup_phrase(user_id)
+
+def pick_backup_phrase(user_id):
+    available_phrases = user_state.unheard(user_id, BACKUP_PHRASES)
     if not available_phrases:
-        user_phrases.clear()
-        available_phrases = backup_phrases
+        user_state.clear(user_id)
+        available_phrases = BACKUP_PHRASES
     phrase = random.choice(available_phrases)
-    user_phrases.append(phrase)
-    if len(user_phrases) > 20:
-        user_phrases.pop(0)
+    user_state.remember(user_id, phrase)
     logger.info(f"Selected backup phrase for user {user_id}: {phrase}")
     return phrase
 
+@metrics.timed("find_meme_emoji")
 async def find_meme_emoji(meme_name_english, meme_name_russian):
     try:
         query = f"{meme_name_english} ({meme_name_russian})"
-        response = await async_client.chat.completions.create(
-            model="meta-llama-3.1-405b-instruct",
-            provider=g4f.Provider.DeepInfra,
-            messages=[{"role": "system", "content": EMOJI_PRESET}, {"role": "user", "content": query}],
-            web_search=False,
-            stream=False
-        )
-        emoji = response.choices[0].message.content.strip()
+        emoji = (await ask_llm(EMOJI_PRESET, query)).strip()
         valid_emojis = ["🦈", "🐊", "🦁", "🦄", "🐧", "🦖", "🎉", "🎸", "🌟", "🍕", "🦊", "🚀"]
         if emoji in valid_emojis:
             logger.info(f"Emoji for {query}: {emoji}")
@@ -116,99 +116,76 @@ async def find_meme_emoji(meme_name_english, meme_name_russian):
         logger.warning(f"Invalid emoji for {query}: {emoji}")
     except Exception as e:
         logger.error(f"Emoji search error for {query}: {e}")
-    return random.choice(["🦈", "🦄", "🦁", "🎸", "🌟"])
+    return None
 
+async def search_photo_g4f(query):
+    photo_url = (await ask_llm(PHOTO_PRESET, query, web_search=True)).strip()
+    logger.info(f"Photo URL from g4f for {query}: {photo_url}")
+    if photo_url != "Фото не найдено 😕" and photo_url.startswith("http"):
+        return photo_url
+    raise LookupError(f"g4f found no photo for {query}")
+
+async def search_photo_google(query):
+    google_url = f"https://www.google.com/search?tbm=isch&q={urllib.parse.quote(query)}"
+    headers = {"User-Agent": "Mozilla/5.0"}
+    await acquire_upstream("google")
+    google_html = await http_pool.fetch_text(google_url, headers=headers, timeout=GOOGLE_TIMEOUT, max_bytes=GOOGLE_MAX_BYTES)
+    soup = BeautifulSoup(google_html, "html.parser")
+    img_tags = soup.find_all("img")
+    for img in img_tags[1:]:
+        src = img.get("src")
+        if src and src.startswith("http"):
+            logger.info(f"Google Images URL for {query}: {src}")
+            return src
+    raise LookupError(f"Google Images found no photo for {query}")
+
+@metrics.timed("find_meme_photo")
 async def find_meme_photo(meme_name_english, meme_name_russian):
+    query = f"{meme_name_english} ({meme_name_russian}) итальянский мем"
+    # Google стартует сразу после ошибки g4f или если тот отвечает дольше обычного
     try:
-        query = f"{meme_name_english} ({meme_name_russian}) итальянский мем"
-        response = await async_client.chat.completions.create(
-            model="meta-llama-3.1-405b-instruct",
-            provider=g4f.Provider.DeepInfra,
-            messages=[{"role": "system", "content": PHOTO_PRESET}, {"role": "user", "content": query}],
-            web_search=True,
-            stream=False
+        return await hedged(
+            [lambda: search_photo_g4f(query), lambda: search_photo_google(query)],
+            tracker("photo", PHOTO_HEDGE_DELAY)
         )
-        photo_url = response.choices[0].message.content.strip()
-        logger.info(f"Photo URL from g4f for {query}: {photo_url}")
-        if photo_url != "Фото не найдено 😕" and photo_url.startswith("http"):
-            return photo_url
     except Exception as e:
         logger.error(f"Photo search error for {query}: {e}")
     
-    try:
-        google_url = f"https://www.google.com/search?tbm=isch&q={urllib.parse.quote(query)}"
-        headers = {"User-Agent": "Mozilla/5.0"}
-        google_response = requests.get(google_url, headers=headers, timeout=30)
-        if google_response.status_code == 200:
-            soup = BeautifulSoup(google_response.text, "html.parser")
-            img_tags = soup.find_all("img")
-            for img in img_tags[1:]:
-                src = img.get("src")
-                if src and src.startswith("http"):
-                    logger.info(f"Google Images URL for {query}: {src}")
-                    return src
-    except Exception as e:
-        logger.error(f"Google Images search error for {query}: {e}")
-    
     logger.warning(f"No photo found for {query}")
     return "Фото не найдено 😕"
 
-def load_memes():
-    global _memes_cache
-    if _memes_cache is not None:
-        return _memes_cache
-    try:
-        if not os.path.exists(MEMES_JSON):
-            logger.error(f"Memes file {MEMES_JSON} not found")
-            return []
-        with open(MEMES_JSON, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            _memes_cache = data.get("memes", [])
-            return _memes_cache
-    except Exception as e:
-        logger.error(f"Load memes error: {e}")
-        return []
-
-def find_closest_meme(query, memes):
-    query = query.lower().strip()
-    logger.info(f"Searching for meme by name: {query}")
-    names = [m["name"].lower() for m in memes]
-    closest = difflib.get_close_matches(query, names, n=1, cutoff=0.3)
-    return next((m for m in memes if m["name"].lower() == closest[0]), None) if closest else None
-
-def find_meme_by_description(query, memes):
-    query = query.lower().strip()
-    logger.info(f"Searching for meme by description: {query}")
-    descriptions = [(m, m["description"].lower()) for m in memes]
-    best_match = None
-    best_ratio = 0.0
-    for meme, desc in descriptions:
-        ratio = difflib.SequenceMatcher(None, query, desc).ratio()
-        if ratio > best_ratio and ratio > 0.5:
-            best_ratio = ratio
-            best_match = meme
-    if best_match:
-        logger.info(f"Found meme by description: {best_match['name']} (ratio: {best_ratio})")
-    return best_match
-
-def download_meme_sound(sound_url, fallback_url, filename):
-    for url in [sound_url, fallback_url]:
-        try:
-            response = requests.get(url, stream=True, timeout=30)
-            response.raise_for_status()
-            with open(filename, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            file_size = os.path.getsize(filename)
-            logger.info(f"Downloaded meme sound from {url} to {filename}, size: {file_size} bytes")
-            return True
-        except Exception as e:
-            logger.error(f"Failed to download meme sound from {url}: {e}")
-    return False
-
-async def generate_meme_audio(text, filename, funny_phrase):
-    sound_effect = random.choice(MEME_SOUNDS)
-    effect_name, effect_url, effect_fallback_url = sound_effect
+async def get_meme_emoji(meme, min_remaining=0.0):
+    emoji = await lookup_cache.get_or_fetch(
+        meme_key("emoji", meme["id"]),
+        lambda: find_meme_emoji(meme["name_english"], meme["name"]),
+        min_remaining=min_remaining
+    )
+    return emoji or random.choice(FALLBACK_EMOJIS)
+
+async def get_meme_photo(meme, min_remaining=0.0):
+    return await lookup_cache.get_or_fetch(
+        meme_key("photo", meme["id"]),
+        lambda: find_meme_photo(meme["name_english"], meme["name"]),
+        is_negative=lambda url: not url.startswith("http"),
+        min_remaining=min_remaining
+    )
+
+def find_meme(query):
+    logger.info(f"Searching for meme: {query}")
+    meme = catalog.by_name(query)
+    if meme is not None:
+        logger.info(f"Found meme: {meme['name']} (exact name)")
+        return meme
+    matches = catalog.search(query, k=1, min_score=SEARCH_MIN_SCORE)
+    if not matches:
+        return None
+    meme, score = matches[0]
+    logger.info(f"Found meme: {meme['name']} (score: {score:.2f})")
+    return meme
+
+@metrics.timed("generate_meme_audio")
+async def generate_meme_audio(text, funny_phrase, sound_effect):
+    effect_name = sound_effect[0]
     
     prompt = (
         f"Озвучь с точным итальянским TikTok-вайбом, как в мемах, с пафосом и энергией: {text}."
@@ -217,44 +194,35 @@ async def generate_meme_audio(text, filename, funny_phrase):
     encoded_prompt = urllib.parse.quote(prompt, safe='')
     url = f"https://text.pollinations.ai/{encoded_prompt}?model=openai-audio&voice=onyx&attitude=excited"
     
+    async def fetch_tts():
+        await acquire_upstream("tts")
+        tts_data = await http_pool.fetch_bytes(url, max_bytes=TTS_MAX_BYTES)
+        if len(tts_data) < 1000:
+            raise ValueError(f"audio too small: {len(tts_data)} bytes")
+        return tts_data
+    
     logger.info(f"Sending audio request to API for text: {text}")
-    for attempt in range(2):
-        try:
-            response = requests.get(url, stream=True, timeout=30)
-            response.raise_for_status()
-            
-            with open(filename, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            
-            file_size = os.path.getsize(filename)
-            logger.info(f"Generated audio file {filename}, size: {file_size} bytes")
-            if file_size < 1000:
-                logger.warning(f"Generated audio file {filename} too small: {file_size} bytes")
-                return False
-            
-            with tempfile.NamedTemporaryFile(suffix=".mp3", dir=AUDIO_DIR, delete=False) as effect_file:
-                if download_meme_sound(effect_url, effect_fallback_url, effect_file.name):
-                    try:
-                        main_audio = AudioSegment.from_mp3(filename)
-                        effect_audio = AudioSegment.from_mp3(effect_file.name) + 5
-                        combined = main_audio + effect_audio
-                        await asyncio.sleep(0.5)
-                        combined.export(filename, format="mp3")
-                        logger.info(f"Successfully added meme sound effect '{effect_name}' to {filename}")
-                    except Exception as e:
-                        logger.warning(f"Failed to overlay meme sound: {e}")
-            
-            final_size = os.path.getsize(filename)
-            logger.info(f"Final audio generated: {filename}, size: {final_size} bytes")
-            return True
-        except requests.HTTPError as e:
-            logger.error(f"Audio API HTTP error (attempt {attempt + 1}): {e}")
-        except Exception as e:
-            logger.error(f"Audio API error (attempt {attempt + 1}): {e}")
+    try:
+        # Второй запрос уходит, если первый упал или отстаёт от обычной задержки TTS
+        tts_data = await hedged([fetch_tts, fetch_tts], tracker("tts", TTS_HEDGE_DELAY))
+    except HTTPError as e:
+        logger.error(f"Audio API HTTP error: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Audio API error: {e}")
+        return None
+    logger.info(f"Generated audio for {text}, size: {len(tts_data)} bytes")
     
-    logger.error("Failed to generate audio after 2 attempts")
-    return False
+    effect_audio = await sound_cache.get(*sound_effect)
+    try:
+        async with metrics.stage("render_voice"):
+            voice_data = await audio_pool.submit(render_voice, tts_data, effect_audio, 5)
+    except Exception as e:
+        # Telegram примет и mp3 как голосовое, просто без эффекта и крупнее
+        logger.warning(f"Failed to render voice with meme sound '{effect_name}': {e}")
+        return {"data": tts_data, "format": "mp3"}
+    logger.info(f"Final voice rendered with '{effect_name}', size: {len(voice_data)} bytes")
+    return {"data": voice_data, "format": "ogg"}
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -273,7 +241,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def random_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        memes = load_memes()
+        memes = catalog.memes()
         if not memes:
             await update.message.reply_text(f"Мемы не найдены! 😕 Попробуй позже.", reply_markup=MENU_KEYBOARD)
             return
@@ -301,14 +269,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await help_command(update, context)
     
     try:
-        memes = load_memes()
-        if not memes:
+        if not catalog.memes():
             await update.message.reply_text(f"Мемы не найдены! 😕🔍 Попробуй другое.", reply_markup=MENU_KEYBOARD)
             return
         
-        meme = find_closest_meme(text, memes)
-        if not meme or difflib.SequenceMatcher(None, text.lower(), meme["name"].lower()).ratio() < 0.6:
-            meme = find_meme_by_description(text, memes) or meme
+        meme = find_meme(text)
         
         if not meme:
             await update.message.reply_text(f"Мем не найден! 😕🦄 Попробуй другое.", reply_markup=MENU_KEYBOARD)
@@ -322,84 +287,161 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Handle text error: {e}")
         await update.message.reply_text(f"Ошибка поиска! 😕🚀 Пробуй снова.", reply_markup=MENU_KEYBOARD)
 
+async def render_meme_audio(meme, funny_phrase, sound_effect):
+    cache_key = audio_cache.make_key(meme["id"], funny_phrase, sound_effect[0])
+    audio = await generate_meme_audio(meme["name_english"], funny_phrase, sound_effect)
+    if audio is None:
+        return None
+    path = None
+    if audio["format"] == "ogg":
+        path = await audio_cache.store(cache_key, audio["data"], meme["id"], funny_phrase, sound_effect[0])
+    return {"data": audio["data"], "path": path, "file_id": None}
+
+@metrics.timed("prepare_meme_response")
 async def prepare_meme_response(meme, user_id):
-    funny_phrase = await generate_funny_phrase(user_id)
-    voice_text = f"{meme['name_english']}"
+    deadline = time.monotonic() + REPLY_DEADLINE
+    prewarmer.record_request(meme)
+    await user_state.load(user_id)
+    
+    photo_task = asyncio.create_task(get_meme_photo(meme))
+    emoji_task = asyncio.create_task(get_meme_emoji(meme))
+    
+    # Если есть прогретая озвучка с фразой, которую юзер ещё не слышал — берём её без LLM
+    variants = await audio_cache.variants(meme["id"])
+    unheard = set(user_state.unheard(user_id, [v["phrase"] for v in variants]))
+    variants = [v for v in variants if v["phrase"] in unheard]
+    sound_by_name = {sound[0]: sound for sound in MEME_SOUNDS}
+    variant = random.choice(variants) if variants else None
+    if variant and variant["effect"] in sound_by_name:
+        funny_phrase = variant["phrase"]
+        sound_effect = sound_by_name[variant["effect"]]
+        user_state.remember(user_id, funny_phrase)
+    else:
+        funny_phrase = await within(generate_funny_phrase(user_id), PHRASE_BUDGET) or pick_backup_phrase(user_id)
+        sound_effect = random.choice(MEME_SOUNDS)
+    cache_key = audio_cache.make_key(meme["id"], funny_phrase, sound_effect[0])
     
     logger.info(f"Preparing response for meme '{meme['name']}' for user {user_id}")
     
-    audio_task = asyncio.create_task(generate_meme_audio(voice_text, f"{AUDIO_DIR}/temp_{user_id}.mp3", funny_phrase))
-    photo_task = asyncio.create_task(find_meme_photo(meme["name_english"], meme["name"]))
-    emoji_task = asyncio.create_task(find_meme_emoji(meme["name_english"], meme["name"]))
+    cached_audio = await audio_cache.lookup(cache_key)
+    if cached_audio:
+        logger.info(f"Audio cache hit for meme '{meme['name']}' (hit ratio: {audio_cache.stats()['hit_ratio']:.2f})")
+        audio_task = asyncio.create_task(asyncio.sleep(0, result=cached_audio))
+    else:
+        audio_task = asyncio.create_task(render_meme_audio(meme, funny_phrase, sound_effect))
     
-    audio_success, photo_url, emoji = await asyncio.gather(audio_task, photo_task, emoji_task)
+    emoji = await within(emoji_task, EMOJI_BUDGET) or random.choice(FALLBACK_EMOJIS)
     
-    try:
-        return {
-            "type": "voice" if audio_success else "text",
-            "voice_text": voice_text,
-            "voice_file": f"{AUDIO_DIR}/temp_{user_id}.mp3" if audio_success else None,
-            "text": (
-                f"{emoji} Озвучка... 🎸\n"
-                f"{meme['name_english']}, {meme['name']}\n\n"
-                f"{meme['description']}\n\n"
-                f"{funny_phrase} 🌟🎉"
-            ),
-            "link": photo_url,
-            "reply_markup": MENU_KEYBOARD
-        }
-    except Exception as e:
-        logger.error(f"Prepare meme response error for user {user_id}: {e}")
-        return {
-            "type": "text",
-            "text": (
-                f"{emoji} {meme['name_english']}, {meme['name']} 🦄\n\n"
-                f"{meme['description']}\n\n"
-                f"{funny_phrase} 🌟🎉"
-            ),
-            "link": "Фото не найдено 😕",
-            "reply_markup": MENU_KEYBOARD
-        }
+    return {
+        "text": (
+            f"{emoji} Озвучка... 🎸\n"
+            f"{meme['name_english']}, {meme['name']}\n\n"
+            f"{meme['description']}\n\n"
+            f"{funny_phrase} 🌟🎉"
+        ),
+        "voice_caption": f"{emoji} {meme['name_english']} 🎸",
+        "audio_task": audio_task,
+        "photo_task": photo_task,
+        "cache_key": cache_key,
+        "render_audio": lambda: render_meme_audio(meme, funny_phrase, sound_effect),
+        "deadline": deadline,
+        "reply_markup": MENU_KEYBOARD
+    }
+
+@metrics.timed("send_voice")
+async def send_voice(update: Update, response, audio):
+    if audio["file_id"]:
+        try:
+            return await update.message.reply_voice(voice=audio["file_id"], caption=response["voice_caption"], reply_markup=response["reply_markup"])
+        except BadRequest as e:
+            # Запрет голосовых, удалённое сообщение и прочие 400 к file_id отношения не имеют
+            if not any(marker in e.message.lower() for marker in FILE_ID_ERRORS):
+                raise
+            logger.warning(f"Cached file_id rejected, re-uploading: {e}")
+            await audio_cache.forget_file_id(response["cache_key"])
+    voice = audio.get("data")
+    if voice is None and audio["path"]:
+        voice = await audio_cache.read(audio["path"])
+    if voice is None:
+        # file_id пришёл от другого воркера или файл уже вытеснен — своей копии нет, озвучиваем заново
+        logger.warning("No local copy of the cached voice, rendering again")
+        # Не дольше общего дедлайна ответа; не успевшая озвучка всё равно ляжет в кэш для следующего раза
+        rendered = await within(response["render_audio"](), response["deadline"] - time.monotonic())
+        if rendered is None:
+            return None
+        voice = rendered["data"]
+    sent = await update.message.reply_voice(voice=voice, caption=response["voice_caption"], reply_markup=response["reply_markup"])
+    if sent.voice:
+        await audio_cache.remember_file_id(response["cache_key"], sent.voice.file_id)
+    return sent
 
+@metrics.timed("send_meme_response")
 async def send_meme_response(update: Update, context: ContextTypes.DEFAULT_TYPE, response, meme):
+    text_sent = False
     try:
-        if response["type"] == "voice":
-            with open(response["voice_file"], "rb") as audio_file:
-                await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="record_voice")
-                await update.message.reply_voice(voice=audio_file, caption=response["text"], reply_markup=response["reply_markup"])
-            logger.info(f"Voice message sent successfully")
-            os.remove(response["voice_file"])
+        # Текст уходит сразу, голос и фото догоняют, но не позже общего дедлайна
+        await update.message.reply_text(response["text"], reply_markup=response["reply_markup"])
+        text_sent = True
+        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="record_voice")
+        
+        audio = await within(response["audio_task"], response["deadline"] - time.monotonic())
+        if audio:
+            if await send_voice(update, response, audio):
+                logger.info(f"Voice message sent successfully")
+            else:
+                logger.warning(f"Voice for '{meme['name']}' could not be sent")
+        elif response["audio_task"].done():
+            logger.warning(f"Voice for '{meme['name']}' failed to render")
         else:
-            await update.message.reply_text(response["text"], reply_markup=response["reply_markup"])
+            logger.warning(f"Voice for '{meme['name']}' missed the reply deadline")
         
-        await update.message.reply_text(response["link"], reply_markup=response["reply_markup"])
+        photo_url = await within(response["photo_task"], response["deadline"] - time.monotonic(), "Фото не найдено 😕")
+        await update.message.reply_text(photo_url, reply_markup=response["reply_markup"])
     except Exception as e:
         logger.error(f"Send meme response error: {e}")
-        emoji = random.choice(["🦈", "🦄", "🦁", "🎸", "🌟"])
-        await update.message.reply_text(
-            f"{emoji} {meme['name_english']}, {meme['name']} 🦄\n\n{meme['description']}\n\n"
-            f"Мем без вайба! 😕 🌟🎉",
-            reply_markup=response["reply_markup"]
-        )
+        # Досылаем только то, что ещё не ушло: фото отправляется последним, значит его точно нет
+        if not text_sent:
+            emoji = random.choice(FALLBACK_EMOJIS)
+            await update.message.reply_text(
+                f"{emoji} {meme['name_english']}, {meme['name']} 🦄\n\n{meme['description']}\n\n"
+                f"Мем без вайба! 😕 🌟🎉",
+                reply_markup=response["reply_markup"]
+            )
         await update.message.reply_text("Фото не найдено 😕", reply_markup=response["reply_markup"])
 
-async def main():
-    TOKEN = os.getenv("TELEGRAM_TOKEN")
-    if not TOKEN:
-        logger.error("TELEGRAM_TOKEN not set in environment variables")
-        raise ValueError("TELEGRAM_TOKEN is required")
-    
-    try:
-        requests.get(f"https://api.telegram.org/bot{TOKEN}/deleteWebhook?drop_pending_updates=True", timeout=10)
-        requests.get(f"https://api.telegram.org/bot{TOKEN}/setWebhook?url=", timeout=10)
-        logger.info("Webhook deleted and reset successfully")
-    except Exception as e:
-        logger.error(f"Failed to delete/reset webhook: {e}")
-    
-    logger.info("MEMEZVUKACH стартует...")
-    
+phrase_pool = PhrasePool(generate_phrase_batch)
+prewarmer = Prewarmer(catalog.memes, render_meme_audio, get_meme_emoji, get_meme_photo, lambda: BACKUP_PHRASES + phrase_pool.sample(8), MEME_SOUNDS)
+
+async def shutdown(app: Application):
+    await prewarmer.stop()
+    await catalog.stop()
+    await phrase_pool.stop()
+    audio_pool.shutdown()
+    await user_state.close()
+    await audio_cache.close()
+    await lookup_cache.close()
+    if shared_backend is not None:
+        shared_backend.close()
+    await http_pool.aclose()
+
+def register_stats(app: Application):
+    web_server.add_stats("updates", app.update_processor.stats)
+    web_server.add_stats("catalog", catalog.stats)
+    web_server.add_stats("audio_cache", audio_cache.stats)
+    web_server.add_stats("lookup_cache", lookup_cache.stats)
+    web_server.add_stats("audio_pool", audio_pool.stats)
+    web_server.add_stats("user_state", user_state.stats)
+    web_server.add_stats("phrase_pool", phrase_pool.stats)
+    web_server.add_stats("prewarm", prewarmer.stats)
+    web_server.add_stats("http_pool", lambda: {"in_flight": http_pool.in_flight})
+    web_server.add_stats("upstream_error_rate", metrics.upstream_error_rates)
+    web_server.add_stats("latency", lambda: {name: latency.stats() for name, latency in trackers.items()})
+    if shared_backend is not None:
+        web_server.add_stats("shared_state", shared_backend.stats)
+
+def build_application(token):
     try:
-        app = Application.builder().token(TOKEN).concurrent_updates(False).build()
+        app = Application.builder().token(token).concurrent_updates(ChatUpdateProcessor()).build()
     except Exception as e:
         logger.error(f"Failed to initialize bot: {e}")
         raise
@@ -408,15 +450,108 @@ async def main():
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("random", random_meme))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    register_stats(app)
+    return app
+
+async def start_background(shard=0):
+    await sound_cache.warm(MEME_SOUNDS)
+    phrase_pool.start()
+    # Прогрев общий для всех воркеров, поэтому его ведёт только первый
+    if shard == 0:
+        prewarmer.start()
+
+def stop_on_signals():
+    stop_signal = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_signal.set)
+        except NotImplementedError:
+            pass
+    return stop_signal
+
+async def serve(app: Application, stop_signal, on_started=None):
+    async with app:
+        # Сервер поднимаем до регистрации вебхука: первые апдейты Telegram не должны упереться в закрытый порт
+        await app.start()
+        await web_server.start()
+        if WEBHOOK_URL:
+            secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+            web_server.set_webhook_handler(lambda data: app.update_queue.put(Update.de_json(data, app.bot)), secret_token)
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True
+            )
+            logger.info(f"Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            await app.bot.delete_webhook(drop_pending_updates=True)
+            await app.updater.start_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+            logger.info("Webhook deleted, polling for updates")
+        if on_started is not None:
+            await on_started()
+        
+        logger.info("Бот готов зажигать TikTok-вайб!")
+        await stop_signal.wait()
+        
+        logger.info("MEMEZVUKACH останавливается...")
+        await web_server.stop()
+        if app.updater.running:
+            await app.updater.stop()
+        await app.stop()
+
+def run_worker(shard, token, updates):
+    asyncio.run(worker_main(shard, token, updates))
+
+async def worker_main(shard, token, updates):
+    # Папка озвучек общая (туда же пишет прогрев шарда 0), индекс и метрики — свои у каждого воркера
+    audio_cache.set_cache_dir(audio_cache.cache_dir, f"index-worker{shard}.json")
+    web_server.host = "127.0.0.1"
+    web_server.port += 1 + shard
+    stop_signal = stop_on_signals()
+    app = build_application(token)
+    try:
+        await catalog.start()
+        async with app:
+            await app.start()
+            await web_server.start()
+            await start_background(shard)
+            logger.info(f"Worker {shard} ready")
+            await feed_updates(updates, lambda data: app.update_queue.put(Update.de_json(data, app.bot)), stop_signal)
+            await web_server.stop()
+            await app.stop()
+    finally:
+        await shutdown(app)
+
+async def main():
+    TOKEN = os.getenv("TELEGRAM_TOKEN")
+    if not TOKEN:
+        logger.error("TELEGRAM_TOKEN not set in environment variables")
+        raise ValueError("TELEGRAM_TOKEN is required")
+    
+    logger.info("MEMEZVUKACH стартует...")
+    stop_signal = stop_on_signals()
     
-    logger.info("Бот готов зажигать TikTok-вайб!")
-    keep_alive()
-    await asyncio.sleep(5)  # Задержка для очистки
+    if WORKERS > 1:
+        # Этот процесс только принимает апдейты и раскладывает их по воркерам по id чата
+        router = ShardRouter(WORKERS, run_worker, TOKEN)
+        ingress = Application.builder().token(TOKEN).build()
+        ingress.add_handler(TypeHandler(Update, router.forward))
+        web_server.add_stats("shards", router.stats)
+        router.start()
+        try:
+            await serve(ingress, stop_signal)
+        finally:
+            router.stop()
+        return
+    
+    app = build_application(TOKEN)
     try:
-        await app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
-    except Exception as e:
-        logger.error(f"Polling error: {e}")
-        raise
+        await catalog.start()
+        await serve(app, stop_signal, start_background)
+    finally:
+        await shutdown(app)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
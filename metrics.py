@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import time
+import asyncio
+import bisect
+import functools
+import threading
+import contextvars
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+
+METRICS_PREFIX = "memezvukach"
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 25.0, 40.0, 60.0)
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "") == "1"
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))
+PROFILER_MAX_SECONDS = 60.0
+
+_NOT_NAME = re.compile(r"[^a-zA-Z0-9_]")
+
+# Чья это работа: ответ юзеру или фоновый прогрев — этапы у них одни, а гистограммы разные (лейбл origin)
+origin = contextvars.ContextVar("metrics_origin", default="user")
+
+
+def metric_name(*parts):
+    return _NOT_NAME.sub("_", "_".join(str(part) for part in parts if part != ""))
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Histogram:
+    """Кумулятивная гистограмма в формате Prometheus."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class Metrics:
+    """Задержки этапов ответа и апстримов, ошибки и запросы в полёте; отдаётся на /metrics."""
+
+    def __init__(self):
+        self.stage_seconds = defaultdict(Histogram)
+        self.stage_errors = Counter()
+        self.stage_in_flight = Counter()
+        self.upstream_seconds = defaultdict(Histogram)
+        self.upstream_requests = Counter()
+        self.upstream_in_flight = Counter()
+
+    @asynccontextmanager
+    async def stage(self, name):
+        key = (name, origin.get())
+        self.stage_in_flight[key] += 1
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.stage_errors[key] += 1
+            raise
+        finally:
+            self.stage_in_flight[key] -= 1
+            self.stage_seconds[key].observe(time.monotonic() - started)
+
+    def timed(self, name):
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                async with self.stage(name):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def upstream_started(self, name):
+        self.upstream_in_flight[name] += 1
+        return time.monotonic()
+
+    def upstream_finished(self, name, started, ok):
+        self.upstream_in_flight[name] -= 1
+        self.upstream_seconds[name].observe(time.monotonic() - started)
+        self.upstream_requests[name, "ok" if ok else "error"] += 1
+
+    @asynccontextmanager
+    async def upstream(self, name):
+        started = self.upstream_started(name)
+        ok = False
+        try:
+            yield
+            ok = True
+        except asyncio.CancelledError:
+            # Как в http_pool: отменённый (например, проигравший hedged) запрос — не ошибка апстрима
+            ok = True
+            raise
+        finally:
+            self.upstream_finished(name, started, ok)
+
+    def upstream_error_rates(self):
+        rates = {}
+        for name in self.upstream_seconds:
+            errors = self.upstream_requests[name, "error"]
+            total = errors + self.upstream_requests[name, "ok"]
+            rates[name] = errors / total if total else 0.0
+        return rates
+
+    def render(self, stats=None):
+        p = METRICS_PREFIX
+        lines = [f"# TYPE {p}_stage_seconds histogram"]
+        for (name, source), histogram in sorted(self.stage_seconds.items()):
+            lines += histogram.render(f"{p}_stage_seconds", f'stage="{_label(name)}",origin="{source}"')
+        lines.append(f"# TYPE {p}_stage_errors_total counter")
+        lines += [
+            f'{p}_stage_errors_total{{stage="{_label(name)}",origin="{source}"}} {count}'
+            for (name, source), count in sorted(self.stage_errors.items())
+        ]
+        lines.append(f"# TYPE {p}_stage_in_flight gauge")
+        lines += [
+            f'{p}_stage_in_flight{{stage="{_label(name)}",origin="{source}"}} {count}'
+            for (name, source), count in sorted(self.stage_in_flight.items())
+        ]
+        lines.append(f"# TYPE {p}_upstream_seconds histogram")
+        for name, histogram in sorted(self.upstream_seconds.items()):
+            lines += histogram.render(f"{p}_upstream_seconds", f'upstream="{_label(name)}"')
+        lines.append(f"# TYPE {p}_upstream_requests_total counter")
+        lines += [
+            f'{p}_upstream_requests_total{{upstream="{_label(name)}",outcome="{outcome}"}} {count}'
+            for (name, outcome), count in sorted(self.upstream_requests.items())
+        ]
+        lines.append(f"# TYPE {p}_upstream_in_flight gauge")
+        lines += [f'{p}_upstream_in_flight{{upstream="{_label(name)}"}} {count}' for name, count in sorted(self.upstream_in_flight.items())]
+        # stats() подсистем (кэши, очереди, пулы) отдаются как gauge: memezvukach_audio_cache_hit_ratio и т.п.
+        for name, value in sorted(flatten(stats or {}).items()):
+            # Целые печатаем как есть: через :g большие счётчики теряли разряды
+            lines.append(f"{p}_{name} {int(value) if isinstance(value, int) else repr(float(value))}")
+        return "\n".join(lines) + "\n"
+
+
+def flatten(stats, prefix=""):
+    flat = {}
+    for key, value in stats.items():
+        name = metric_name(prefix, key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+class SamplingProfiler:
+    """Снимает стек главного потока раз в interval; результат — folded stacks для flamegraph.pl."""
+
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self.thread_id = threading.main_thread().ident
+        self._lock = threading.Lock()
+
+    def sample(self, seconds):
+        seconds = min(seconds, PROFILER_MAX_SECONDS)
+        stacks = Counter()
+        # Один снимок за раз: параллельные запросы профиля только мешали бы друг другу
+        with self._lock:
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(self.thread_id)
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if names:
+                    stacks[";".join(reversed(names))] += 1
+                time.sleep(self.interval)
+        return stacks
+
+    @staticmethod
+    def folded(stacks):
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+metrics = Metrics()
+profiler = SamplingProfiler() if PROFILER_ENABLED else None
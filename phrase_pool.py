@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import random
+import asyncio
+import logging
+from user_state import user_state
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+PHRASE_POOL_SIZE = int(os.getenv("PHRASE_POOL_SIZE", "200"))
+PHRASE_POOL_LOW_WATERMARK = int(os.getenv("PHRASE_POOL_LOW_WATERMARK", "60"))
+PHRASE_BATCH_SIZE = int(os.getenv("PHRASE_BATCH_SIZE", "25"))
+PHRASE_MAX_USES = int(os.getenv("PHRASE_MAX_USES", "50"))
+PHRASE_MAX_LENGTH = 50
+PHRASE_PICK_ATTEMPTS = 8
+PHRASE_REFILL_BACKOFF = 30.0
+
+_LIST_MARKER = re.compile(r"^\s*(?:\d+[.)]|[-•*])\s*")
+
+
+def clean_phrase(line):
+    phrase = _LIST_MARKER.sub("", line).strip().strip("\"'«»").strip()
+    if phrase and len(phrase) <= PHRASE_MAX_LENGTH:
+        return phrase
+    return None
+
+
+class PhrasePool:
+    """Запас готовых фраз, который фоново пополняется пачками из LLM."""
+
+    def __init__(self, generate_batch, size=PHRASE_POOL_SIZE, low_watermark=PHRASE_POOL_LOW_WATERMARK,
+                 batch_size=PHRASE_BATCH_SIZE, max_uses=PHRASE_MAX_USES):
+        self.generate_batch = generate_batch
+        self.size = size
+        self.low_watermark = low_watermark
+        self.batch_size = batch_size
+        self.max_uses = max_uses
+        # Список + индекс по фразе: выбор и удаление за O(1)
+        self._phrases = []
+        self._index = {}
+        self._uses = {}
+        self._seen = set()
+        self._low = None
+        self._task = None
+        self.picks = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_errors = 0
+
+    def __len__(self):
+        return len(self._phrases)
+
+    def add(self, lines):
+        if len(self._seen) > 20 * self.size:
+            self._seen = set(self._phrases)
+        added = 0
+        for line in lines:
+            phrase = clean_phrase(line)
+            if phrase is None or phrase in self._seen or len(self._phrases) >= self.size:
+                continue
+            self._seen.add(phrase)
+            self._index[phrase] = len(self._phrases)
+            self._phrases.append(phrase)
+            self._uses[phrase] = 0
+            added += 1
+        return added
+
+    def _retire(self, phrase):
+        position = self._index.pop(phrase)
+        last = self._phrases.pop()
+        if last != phrase:
+            self._phrases[position] = last
+            self._index[last] = position
+        del self._uses[phrase]
+
+    def pick(self, user_id):
+        phrase = None
+        for _ in range(min(PHRASE_PICK_ATTEMPTS, len(self._phrases))):
+            candidate = random.choice(self._phrases)
+            if not user_state.has_heard(user_id, candidate):
+                phrase = candidate
+                break
+        if phrase is None:
+            self.misses += 1
+        else:
+            self.picks += 1
+            self._uses[phrase] += 1
+            if self._uses[phrase] >= self.max_uses:
+                self._retire(phrase)
+        if len(self._phrases) < self.low_watermark and self._low is not None:
+            self._low.set()
+        return phrase
+
+    def sample(self, count):
+        return random.sample(self._phrases, min(count, len(self._phrases)))
+
+    async def refill(self):
+        while len(self._phrases) < self.size:
+            lines = await self.generate_batch(self.batch_size)
+            added = self.add(lines)
+            self.refills += 1
+            logger.info(f"Phrase pool refilled: +{added}, size {len(self._phrases)}")
+            if not added:
+                return False
+        return True
+
+    async def _refill_loop(self):
+        while True:
+            await self._low.wait()
+            self._low.clear()
+            try:
+                if not await self.refill():
+                    # LLM отдаёт одни повторы или мусор: не дёргаем его на каждом pick(), ждём как после ошибки
+                    logger.warning(f"Phrase pool refill added nothing, retrying in {PHRASE_REFILL_BACKOFF:.0f}s")
+                    await asyncio.sleep(PHRASE_REFILL_BACKOFF)
+                    self._low.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.refill_errors += 1
+                logger.error(f"Phrase pool refill error: {e}")
+                await asyncio.sleep(PHRASE_REFILL_BACKOFF)
+                self._low.set()
+
+    def stats(self):
+        return {
+            "size": len(self._phrases),
+            "picks": self.picks,
+            "misses": self.misses,
+            "refills": self.refills,
+            "refill_errors": self.refill_errors,
+        }
+
+    def start(self):
+        if self._task is None:
+            self._low = asyncio.Event()
+            self._low.set()
+            self._task = asyncio.create_task(self._refill_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import random
+import asyncio
+import itertools
+import logging
+from collections import Counter
+from audio_cache import audio_cache
+from lookup_cache import lookup_cache, meme_key
+from metrics import origin
+from shared_state import shared_backend, caller_limits, RateLimiter
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+PREWARM_WORKERS = int(os.getenv("PREWARM_WORKERS", "3"))
+PREWARM_INTERVAL = float(os.getenv("PREWARM_INTERVAL", "1800"))
+PREWARM_VARIANTS = int(os.getenv("PREWARM_VARIANTS", "2"))
+PREWARM_TTS_PER_MINUTE = float(os.getenv("PREWARM_TTS_PER_MINUTE", "10"))
+PREWARM_LLM_PER_MINUTE = float(os.getenv("PREWARM_LLM_PER_MINUTE", "20"))
+PREWARM_GOOGLE_PER_MINUTE = float(os.getenv("PREWARM_GOOGLE_PER_MINUTE", "10"))
+# Как часто воркер досылает свои счётчики запросов в общий бэкенд и сколько они там живут
+PREWARM_COUNTS_SYNC = float(os.getenv("PREWARM_COUNTS_SYNC", "30"))
+PREWARM_COUNTS_TTL = 7 * 24 * 3600
+PREWARM_COUNTS_KEY = "prewarm:requests"
+
+
+class Prewarmer:
+    """Фоновый прогрев озвучек, эмодзи и фото для всех мемов, популярные — первыми."""
+
+    def __init__(self, load_memes, render_audio, get_emoji, get_photo, phrases, sounds,
+                 workers=PREWARM_WORKERS, interval=PREWARM_INTERVAL, variants=PREWARM_VARIANTS, backend=shared_backend):
+        self.load_memes = load_memes
+        self.render_audio = render_audio
+        self.get_emoji = get_emoji
+        self.get_photo = get_photo
+        self.phrases = phrases
+        self.sounds = sounds
+        self.workers = workers
+        self.interval = interval
+        self.variants = variants
+        # Прогревает один воркер, а запросы приходят во все — популярность копится в общем бэкенде
+        self.backend = backend
+        self.limits = {
+            "tts": RateLimiter(PREWARM_TTS_PER_MINUTE, "prewarm:tts", backend),
+            "llm": RateLimiter(PREWARM_LLM_PER_MINUTE, "prewarm:llm", backend),
+            "google": RateLimiter(PREWARM_GOOGLE_PER_MINUTE, "prewarm:google", backend),
+        }
+        self.request_counts = Counter()
+        self._unshared_counts = Counter()
+        self._shared_at = time.monotonic()
+        self._sharing = set()
+        self.completed = 0
+        self.failed = 0
+        self.cycles = 0
+        self.voice_ready = 0
+        self.assets_ready = 0
+        self._queue = None
+        self._pending = set()
+        self._seq = itertools.count()
+        self._tasks = []
+
+    def record_request(self, meme):
+        self.request_counts[meme["id"]] += 1
+        if self.backend is not None:
+            self._unshared_counts[meme["id"]] += 1
+            if time.monotonic() - self._shared_at > PREWARM_COUNTS_SYNC:
+                self._share_counts()
+        if self._queue is not None:
+            # Проверка ходит в кэши и общий бэкенд — её делает воркер, хендлер не ждёт
+            self._enqueue(meme, "check")
+
+    def _share_counts(self):
+        counts, self._unshared_counts = self._unshared_counts, Counter()
+        self._shared_at = time.monotonic()
+        if not counts:
+            return
+        task = asyncio.ensure_future(self.backend.incr_many(PREWARM_COUNTS_KEY, counts, PREWARM_COUNTS_TTL))
+        self._sharing.add(task)
+        task.add_done_callback(self._shared)
+
+    def _shared(self, task):
+        self._sharing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Failed to share prewarm request counts: {task.exception()}")
+
+    async def _load_counts(self):
+        if self.backend is None:
+            return
+        try:
+            shared = await self.backend.counters(PREWARM_COUNTS_KEY)
+        except Exception as e:
+            logger.warning(f"Failed to load shared prewarm request counts: {e}")
+            return
+        # Свои ещё не отправленные запросы тоже в счёт
+        self.request_counts = Counter({int(meme_id): count for meme_id, count in shared.items()}) + self._unshared_counts
+
+    async def _missing(self, meme):
+        kinds = []
+        if len(await audio_cache.variants(meme["id"])) < self.variants:
+            kinds.append("voice")
+        if not await self._assets_ready(meme):
+            kinds.append("assets")
+        return kinds
+
+    async def _assets_ready(self, meme):
+        # Обновляем заранее, чтобы запись не протухла до следующего цикла
+        for kind in ("emoji", "photo"):
+            if not await lookup_cache.is_fresh(meme_key(kind, meme["id"]), self.interval):
+                return False
+        return True
+
+    def _enqueue(self, meme, kind):
+        job = (meme["id"], kind)
+        if job in self._pending:
+            return
+        self._pending.add(job)
+        self._queue.put_nowait((-self.request_counts[meme["id"]], next(self._seq), kind, meme))
+
+    async def _enqueue_missing(self, meme):
+        missing = await self._missing(meme)
+        for kind in missing:
+            self._enqueue(meme, kind)
+        return missing
+
+    async def _schedule(self):
+        while True:
+            await self._load_counts()
+            memes = sorted(self.load_memes(), key=lambda m: -self.request_counts[m["id"]])
+            voice_ready = assets_ready = 0
+            for meme in memes:
+                missing = await self._enqueue_missing(meme)
+                voice_ready += "voice" not in missing
+                assets_ready += "assets" not in missing
+            # stats() зовётся синхронно из /stats, поэтому готовность считаем раз за цикл
+            self.voice_ready = voice_ready
+            self.assets_ready = assets_ready
+            self.cycles += 1
+            logger.info(f"Prewarm cycle {self.cycles}: {self.stats()}")
+            await asyncio.sleep(self.interval)
+
+    async def _warm_voice(self, meme):
+        used = {variant["phrase"] for variant in await audio_cache.variants(meme["id"])}
+        candidates = [p for p in self.phrases() if p not in used]
+        if not candidates:
+            return
+        audio = await self.render_audio(meme, random.choice(candidates), random.choice(self.sounds))
+        if audio is None:
+            raise RuntimeError(f"audio render failed for meme {meme['id']}")
+
+    async def _warm_assets(self, meme):
+        for kind, get in (("emoji", self.get_emoji), ("photo", self.get_photo)):
+            if not await lookup_cache.is_fresh(meme_key(kind, meme["id"]), self.interval):
+                await get(meme, self.interval)
+
+    async def _worker(self):
+        # Задачи воркера и всё, что они порождают, идут в метрики с origin="prewarm"
+        origin.set("prewarm")
+        # Бюджет прогрева списывается на каждую попытку к апстриму, включая hedged, а не на весь вызов
+        caller_limits.set(self.limits)
+        while True:
+            _, _, kind, meme = await self._queue.get()
+            try:
+                if kind == "check":
+                    await self._enqueue_missing(meme)
+                    continue
+                if kind == "voice":
+                    await self._warm_voice(meme)
+                else:
+                    await self._warm_assets(meme)
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"Prewarm {kind} failed for meme '{meme['name']}': {e}")
+            finally:
+                self._pending.discard((meme["id"], kind))
+                self._queue.task_done()
+            if (self.completed + self.failed) % 10 == 0:
+                logger.info(f"Prewarm progress: {self.stats()}")
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cycles": self.cycles,
+            "voice_ready": self.voice_ready,
+            "assets_ready": self.assets_ready,
+            "memes": len(self.load_memes()),
+        }
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._schedule())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Prewarm started with {self.workers} workers")
+
+    async def stop(self):
+        if self.backend is not None:
+            self._share_counts()
+            await asyncio.gather(*self._sharing, return_exceptions=True)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import re
+import heapq
+import unicodedata
+from collections import Counter
+from itertools import chain
+from operator import itemgetter
+
+CYRILLIC_TO_LATIN = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh", "з": "z", "и": "i",
+    "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t",
+    "у": "u", "ф": "f", "х": "h", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sch", "ъ": "", "ы": "i", "ь": "",
+    "э": "e", "ю": "yu", "я": "ya",
+}
+# Латиница и кириллица сводятся к одной "фонетической" форме: Crocodilo == Крокодило
+LATIN_FOLDS = [("ph", "f"), ("ck", "k"), ("c", "k"), ("q", "k"), ("w", "v"), ("x", "ks"), ("y", "i"), ("j", "i")]
+NAME_FIELDS = ("name", "name_english")
+TEXT_FIELDS = ("tiktok_phrase", "slogan", "description")
+TEXT_WEIGHT = 0.75
+STOP_TRIGRAM_SHARE = 0.05
+TEXT_CONFIDENT_GRAMS = 10
+
+_TRANSLIT = str.maketrans(CYRILLIC_TO_LATIN)
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+_REPEATS = re.compile(r"(.)\1+")
+
+
+def normalize(text):
+    text = text.lower().translate(_TRANSLIT)
+    if not text.isascii():
+        text = "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+    for source, target in LATIN_FOLDS:
+        text = text.replace(source, target)
+    text = _REPEATS.sub(r"\1", text)
+    return _NON_WORD.sub(" ", text).strip()
+
+
+def trigrams(text):
+    grams = set()
+    for word in normalize(text).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class MemeSearchIndex:
+    """Триграммный инвертированный индекс по полям мемов, строится один раз на каталог."""
+
+    def __init__(self, memes):
+        self.memes = memes
+        self._name_postings = {}
+        self._name_sizes = []
+        self._text_postings = {}
+        for doc, meme in enumerate(memes):
+            for field_no, field in enumerate(NAME_FIELDS):
+                grams = trigrams(meme.get(field) or "")
+                self._name_sizes.append(len(grams))
+                for gram in grams:
+                    self._name_postings.setdefault(gram, []).append(doc * len(NAME_FIELDS) + field_no)
+            text = " ".join(meme.get(field) or "" for field in TEXT_FIELDS)
+            for gram in trigrams(text):
+                self._text_postings.setdefault(gram, []).append(doc)
+        self._stop_df = max(50, int(len(memes) * STOP_TRIGRAM_SHARE))
+
+    def search(self, query, k=5, min_score=0.0):
+        grams = trigrams(query)
+        if not grams:
+            return []
+        scores = {}
+        # Триграммы, которые есть у слишком многих мемов, ничего не различают — пропускаем их
+        name_lists = [self._name_postings.get(gram, ()) for gram in grams]
+        name_hits = Counter(chain.from_iterable(postings for postings in name_lists if len(postings) <= self._stop_df))
+        for posting, count in name_hits.items():
+            score = 2.0 * count / (len(grams) + self._name_sizes[posting])
+            doc = posting // len(NAME_FIELDS)
+            if score > scores.get(doc, 0.0):
+                scores[doc] = score
+        text_lists = [self._text_postings.get(gram, ()) for gram in grams]
+        text_lists = [postings for postings in text_lists if len(postings) <= self._stop_df]
+        if text_lists:
+            # Короткий запрос легко "содержится" в любом длинном описании — штрафуем
+            confidence = min(1.0, len(text_lists) / TEXT_CONFIDENT_GRAMS) * TEXT_WEIGHT / len(text_lists)
+            for doc, count in Counter(chain.from_iterable(text_lists)).most_common(k):
+                score = count * confidence
+                if score > scores.get(doc, 0.0):
+                    scores[doc] = score
+        best = heapq.nlargest(k, scores.items(), key=itemgetter(1))
+        return [(self.memes[doc], score) for doc, score in best if score >= min_score]
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import os
+import queue
+import asyncio
+import logging
+import multiprocessing
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_POLL_INTERVAL = 0.5
+WORKER_STOP_TIMEOUT = 15.0
+
+
+def shard_for(update, workers):
+    # Все апдейты одного чата уходят в один воркер — так сохраняется порядок внутри чата
+    if update.effective_chat is not None:
+        key = update.effective_chat.id
+    elif update.effective_user is not None:
+        key = update.effective_user.id
+    else:
+        key = 0
+    return key % workers
+
+
+class ShardRouter:
+    """Раздаёт апдейты от одного входа (вебхук или polling) по процессам-воркерам."""
+
+    def __init__(self, workers, target, *args):
+        self.workers = workers
+        self.target = target
+        self.args = args
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+        self.forwarded = [0] * workers
+        self.restarts = 0
+
+    def _spawn(self, shard):
+        process = self._context.Process(
+            target=self.target, args=(shard, *self.args, self.queues[shard]), name=f"worker-{shard}"
+        )
+        process.start()
+        self.processes[shard] = process
+        logger.info(f"Started worker {shard} (pid {process.pid})")
+
+    def start(self):
+        for shard in range(self.workers):
+            self._spawn(shard)
+
+    async def forward(self, update, context):
+        shard = shard_for(update, self.workers)
+        if not self.processes[shard].is_alive():
+            # Очередь переживает воркер: новый процесс дочитает то, что не успел упавший
+            logger.error(f"Worker {shard} died with code {self.processes[shard].exitcode}, restarting")
+            self.restarts += 1
+            self._spawn(shard)
+        self.queues[shard].put(update.to_dict())
+        self.forwarded[shard] += 1
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "alive": sum(1 for process in self.processes if process is not None and process.is_alive()),
+            "restarts": self.restarts,
+            "forwarded": {f"shard{shard}": count for shard, count in enumerate(self.forwarded)},
+        }
+
+    def stop(self):
+        for updates in self.queues:
+            updates.put(None)
+        for shard, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"Worker {shard} did not stop in time, terminating")
+                process.terminate()
+                process.join()
+
+
+async def feed_updates(updates, put, stopping):
+    """Сторона воркера: перекладывает апдейты из очереди роутера в очередь приложения."""
+    while not stopping.is_set():
+        try:
+            data = await asyncio.to_thread(updates.get, True, WORKER_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+        if data is None:
+            stopping.set()
+            break
+        await put(data)
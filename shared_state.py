@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+import contextvars
+from sharding import WORKERS
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+# sqlite:///путь, просто путь к файлу или redis://хост:порт/база; пусто — у каждого процесса своё состояние
+SHARED_STATE = os.getenv("SHARED_STATE", os.path.join("meme_audios", "shared.sqlite3") if WORKERS > 1 else "")
+SQLITE_PURGE_EVERY = 1000
+# Сколько секунд прочитанное из бэкенда живёт в памяти процесса, чтобы не ходить за ним на каждый запрос
+SHARED_MEMO_TTL = float(os.getenv("SHARED_MEMO_TTL", "2"))
+SHARED_MEMO_MAX = 10000
+# Общие на все воркеры лимиты живых запросов к провайдерам, вызовов в минуту; 0 — без лимита
+UPSTREAM_TTS_PER_MINUTE = float(os.getenv("UPSTREAM_TTS_PER_MINUTE", "600"))
+UPSTREAM_LLM_PER_MINUTE = float(os.getenv("UPSTREAM_LLM_PER_MINUTE", "600"))
+UPSTREAM_GOOGLE_PER_MINUTE = float(os.getenv("UPSTREAM_GOOGLE_PER_MINUTE", "120"))
+
+
+class SQLiteBackend:
+    """Общее состояние воркеров одной машины в SQLite (WAL): ключи с TTL, множества, счётчики, лимиты."""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._writes = 0
+        # Вызовы приходят из потоков asyncio.to_thread, а соединение у процесса одно
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # isolation_level=None: транзакции открываем сами, чтобы лимит брался под BEGIN IMMEDIATE
+            self._db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sets "
+                "(key TEXT NOT NULL, member TEXT NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (key, member))"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS limits (name TEXT PRIMARY KEY, next_at REAL NOT NULL)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS counters "
+                "(key TEXT NOT NULL, field TEXT NOT NULL, value INTEGER NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (key, field))"
+            )
+        return self._db
+
+    def _purge(self):
+        self._writes += 1
+        if self._writes % SQLITE_PURGE_EVERY == 0:
+            now = time.time()
+            self._db.execute("DELETE FROM kv WHERE expires_at < ?", (now,))
+            self._db.execute("DELETE FROM sets WHERE expires_at < ?", (now,))
+            self._db.execute("DELETE FROM counters WHERE expires_at < ?", (now,))
+
+    def get(self, key):
+        with self._lock:
+            row = self._connect().execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] < time.time():
+                return None
+            return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        self.set_many([(key, value)], ttl)
+
+    def set_many(self, items, ttl):
+        with self._lock:
+            db = self._connect()
+            expires_at = time.time() + ttl
+            db.execute("BEGIN")
+            try:
+                db.executemany(
+                    "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                    [(key, json.dumps(value, ensure_ascii=False), expires_at) for key, value in items],
+                )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            self._purge()
+
+    def delete(self, key):
+        with self._lock:
+            self._connect().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def set_add(self, key, member, ttl):
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO sets (key, member, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(member, ensure_ascii=False), time.time() + ttl),
+            )
+            self._purge()
+
+    def set_members(self, key):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT member FROM sets WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchall()
+            return [json.loads(row[0]) for row in rows]
+
+    def incr_many(self, key, counts, ttl):
+        with self._lock:
+            db = self._connect()
+            expires_at = time.time() + ttl
+            db.execute("BEGIN")
+            try:
+                db.executemany(
+                    "INSERT INTO counters (key, field, value, expires_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (key, field) DO UPDATE SET value = value + excluded.value, expires_at = excluded.expires_at",
+                    [(key, str(field), amount, expires_at) for field, amount in counts.items()],
+                )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            self._purge()
+
+    def counters(self, key):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT field, value FROM counters WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchall()
+            return dict(rows)
+
+    def reserve(self, name, interval):
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT next_at FROM limits WHERE name = ?", (name,)).fetchone()
+                now = time.time()
+                start = max(now, row[0] if row else 0.0)
+                db.execute("INSERT OR REPLACE INTO limits (name, next_at) VALUES (?, ?)", (name, start + interval))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            return start - now
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# Тот же алгоритм, что в SQLiteBackend.reserve, но атомарно на стороне Redis и по его часам
+RESERVE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local start = math.max(now, tonumber(redis.call('GET', KEYS[1]) or '0'))
+local interval = tonumber(ARGV[1])
+redis.call('SET', KEYS[1], tostring(start + interval), 'EX', math.ceil(interval) + 60)
+return tostring(start - now)
+"""
+
+
+class RedisBackend:
+    """То же, что SQLiteBackend, но в Redis (или совместимом сервере) — для нескольких машин."""
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("SHARED_STATE points to Redis, but the redis package is not installed")
+        self._redis = redis.Redis.from_url(url)
+        self._reserve = self._redis.register_script(RESERVE_SCRIPT)
+
+    def get(self, key):
+        value = self._redis.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self._redis.set(key, json.dumps(value, ensure_ascii=False), ex=max(1, int(ttl)))
+
+    def set_many(self, items, ttl):
+        pipeline = self._redis.pipeline(transaction=False)
+        for key, value in items:
+            pipeline.set(key, json.dumps(value, ensure_ascii=False), ex=max(1, int(ttl)))
+        pipeline.execute()
+
+    def delete(self, key):
+        self._redis.delete(key)
+
+    def set_add(self, key, member, ttl):
+        pipeline = self._redis.pipeline(transaction=False)
+        pipeline.sadd(key, json.dumps(member, ensure_ascii=False))
+        pipeline.expire(key, max(1, int(ttl)))
+        pipeline.execute()
+
+    def set_members(self, key):
+        return [json.loads(member) for member in self._redis.smembers(key)]
+
+    def incr_many(self, key, counts, ttl):
+        pipeline = self._redis.pipeline(transaction=False)
+        for field, amount in counts.items():
+            pipeline.hincrby(key, str(field), amount)
+        pipeline.expire(key, max(1, int(ttl)))
+        pipeline.execute()
+
+    def counters(self, key):
+        return {field.decode(): int(value) for field, value in self._redis.hgetall(key).items()}
+
+    def reserve(self, name, interval):
+        return float(self._reserve(keys=[name], args=[interval]))
+
+    def close(self):
+        self._redis.close()
+
+
+class SharedState:
+    """Асинхронный фасад бэкенда: вызовы уходят в поток, прочитанное коротко помнится в процессе."""
+
+    def __init__(self, backend, memo_ttl=SHARED_MEMO_TTL):
+        self.backend = backend
+        self.memo_ttl = memo_ttl
+        self._memo = {}
+        self.calls = 0
+        self.memo_hits = 0
+
+    def _recall(self, key):
+        item = self._memo.get(key)
+        if item is None or item[0] < time.monotonic():
+            return False, None
+        self.memo_hits += 1
+        return True, item[1]
+
+    def _remember(self, key, value):
+        if len(self._memo) >= SHARED_MEMO_MAX:
+            now = time.monotonic()
+            self._memo = {k: item for k, item in self._memo.items() if item[0] >= now}
+            if len(self._memo) >= SHARED_MEMO_MAX:
+                self._memo.clear()
+        self._memo[key] = (time.monotonic() + self.memo_ttl, value)
+
+    async def _call(self, method, *args):
+        self.calls += 1
+        return await asyncio.to_thread(getattr(self.backend, method), *args)
+
+    async def get(self, key):
+        found, value = self._recall(key)
+        if not found:
+            value = await self._call("get", key)
+            self._remember(key, value)
+        return value
+
+    async def set(self, key, value, ttl):
+        self._remember(key, value)
+        await self._call("set", key, value, ttl)
+
+    async def set_many(self, items, ttl):
+        for key, value in items:
+            self._remember(key, value)
+        await self._call("set_many", items, ttl)
+
+    async def delete(self, key):
+        self._remember(key, None)
+        await self._call("delete", key)
+
+    async def set_add(self, key, member, ttl):
+        self._memo.pop(("members", key), None)
+        await self._call("set_add", key, member, ttl)
+
+    async def set_members(self, key):
+        found, members = self._recall(("members", key))
+        if not found:
+            members = await self._call("set_members", key)
+            self._remember(("members", key), members)
+        return members
+
+    async def incr_many(self, key, counts, ttl):
+        await self._call("incr_many", key, counts, ttl)
+
+    async def counters(self, key):
+        return await self._call("counters", key)
+
+    async def reserve(self, name, interval):
+        return await self._call("reserve", name, interval)
+
+    def stats(self):
+        return {"backend": type(self.backend).__name__, "calls": self.calls, "memo_hits": self.memo_hits}
+
+    def close(self):
+        self.backend.close()
+
+
+class RateLimiter:
+    """Равномерно разносит вызовы к провайдеру: не чаще rate_per_minute (с бэкендом — на все процессы)."""
+
+    def __init__(self, rate_per_minute, name=None, backend=None):
+        self.interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self.name = name
+        self.backend = backend
+        self._next_at = 0.0
+
+    async def acquire(self):
+        if self.backend is not None and self.interval:
+            wait = await self.backend.reserve(f"limit:{self.name}", self.interval)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            return
+        now = time.monotonic()
+        wait = self._next_at - now
+        self._next_at = max(now, self._next_at) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def open_backend(spec=SHARED_STATE):
+    if not spec:
+        return None
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        backend = RedisBackend(spec)
+    else:
+        backend = SQLiteBackend(spec[len("sqlite:///"):] if spec.startswith("sqlite:///") else spec)
+    logger.info(f"Shared state backend: {type(backend).__name__}")
+    return SharedState(backend)
+
+
+shared_backend = open_backend()
+
+
+upstream_limits = {
+    "tts": RateLimiter(UPSTREAM_TTS_PER_MINUTE, "upstream:tts", shared_backend),
+    "llm": RateLimiter(UPSTREAM_LLM_PER_MINUTE, "upstream:llm", shared_backend),
+    "google": RateLimiter(UPSTREAM_GOOGLE_PER_MINUTE, "upstream:google", shared_backend),
+}
+# Свои лимиты вызывающего поверх общих (так прогрев держит свой бюджет); контекст наследуют и hedged-попытки
+caller_limits = contextvars.ContextVar("caller_limits", default=None)
+
+
+async def acquire_upstream(kind):
+    """Берёт токен на одну попытку запроса к апстриму: сначала лимит вызывающего, потом общий."""
+    limit = (caller_limits.get() or {}).get(kind)
+    # Общий слот берём последним, чтобы не держать его, пока ждём более медленный лимит прогрева
+    if limit is not None:
+        await limit.acquire()
+    await upstream_limits[kind].acquire()
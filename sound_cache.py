@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from pydub import AudioSegment
+from http_pool import http_pool
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+SOUND_CACHE_DIR = os.getenv("SOUND_CACHE_DIR", os.path.join("meme_audios", "sounds"))
+SOUND_CACHE_MAX_AGE = float(os.getenv("SOUND_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+SOUND_MIN_SIZE = 1000
+SOUND_MAX_SIZE = 10 * 1024 * 1024
+SOUND_REFRESH_RETRY = 600
+
+
+class SoundCache:
+    """Звуковые эффекты на диске по sha256 содержимого + декодированный PCM в памяти."""
+
+    def __init__(self, cache_dir=SOUND_CACHE_DIR, max_age=SOUND_CACHE_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self._index = None
+        self._segments = {}
+        self._locks = {}
+        self._retry_after = {}
+
+    def _load_index(self):
+        if self._index is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self._index = json.load(f)
+            except FileNotFoundError:
+                self._index = {}
+            except Exception as e:
+                logger.warning(f"Sound cache index unreadable, starting empty: {e}")
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cache_dir, f"{digest}.mp3")
+
+    def _read_blob(self, name):
+        entry = self._load_index().get(name)
+        if not entry:
+            return None
+        try:
+            with open(self._blob_path(entry["sha256"]), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != entry["sha256"]:
+            logger.warning(f"Sound cache blob for {name} failed validation")
+            return None
+        return data
+
+    def _is_stale(self, name):
+        entry = self._load_index().get(name)
+        if not entry:
+            return True
+        now = time.time()
+        return now - entry.get("fetched_at", 0) > self.max_age and now >= self._retry_after.get(name, 0)
+
+    def _store_blob(self, name, url, data):
+        index = self._load_index()
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        old = index.get(name)
+        index[name] = {"sha256": digest, "url": url, "size": len(data), "fetched_at": time.time()}
+        self._save_index()
+        if old and old["sha256"] != digest and not any(e["sha256"] == old["sha256"] for e in index.values()):
+            try:
+                os.remove(self._blob_path(old["sha256"]))
+            except OSError:
+                pass
+
+    async def _fetch(self, name, url, fallback_url):
+        for source in [url, fallback_url]:
+            try:
+                data = await http_pool.fetch_bytes(source, max_bytes=SOUND_MAX_SIZE)
+                if len(data) < SOUND_MIN_SIZE:
+                    logger.warning(f"Meme sound from {source} too small: {len(data)} bytes")
+                    continue
+                self._store_blob(name, source, data)
+                logger.info(f"Cached meme sound {name} from {source}, size: {len(data)} bytes")
+                return data
+            except Exception as e:
+                logger.error(f"Failed to download meme sound from {source}: {e}")
+        return None
+
+    async def _ensure(self, name, url, fallback_url):
+        if name in self._segments and not self._is_stale(name):
+            return self._segments[name]
+        if name not in self._segments and time.time() < self._retry_after.get(name, 0):
+            # Негативный кэш: источник недавно не ответил, не ходим к нему на каждый запрос
+            return None
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            if name in self._segments and not self._is_stale(name):
+                return self._segments[name]
+            if name not in self._segments and time.time() < self._retry_after.get(name, 0):
+                return None
+            data = self._read_blob(name)
+            if data is None or self._is_stale(name):
+                # Запасной URL трогаем только при промахе основного
+                fresh = await self._fetch(name, url, fallback_url)
+                if fresh is None:
+                    self._retry_after[name] = time.time() + SOUND_REFRESH_RETRY
+                    if data is not None:
+                        logger.warning(f"Refresh of meme sound {name} failed, keeping cached copy")
+                    else:
+                        logger.warning(f"Meme sound {name} unavailable, retrying in {SOUND_REFRESH_RETRY}s")
+                        return self._segments.get(name)
+                else:
+                    self._retry_after.pop(name, None)
+                if fresh == data and name in self._segments:
+                    return self._segments[name]
+                data = fresh if fresh is not None else data
+            if data is None:
+                return self._segments.get(name)
+            try:
+                segment = await asyncio.to_thread(AudioSegment.from_file, io.BytesIO(data), format="mp3")
+            except Exception as e:
+                logger.error(f"Failed to decode meme sound {name}: {e}")
+                return self._segments.get(name)
+            self._segments[name] = segment
+            return segment
+
+    async def get(self, name, url, fallback_url):
+        return await self._ensure(name, url, fallback_url)
+
+    async def warm(self, sounds):
+        results = await asyncio.gather(*(self._ensure(*sound) for sound in sounds))
+        loaded = sum(1 for segment in results if segment is not None)
+        logger.info(f"Sound cache warmed: {loaded}/{len(sounds)} effects ready")
+        return loaded
+
+
+sound_cache = SoundCache()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import asyncio
+import logging
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "1024"))
+UPDATE_CHAT_QUEUE_CAP = int(os.getenv("UPDATE_CHAT_QUEUE_CAP", "3"))
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов: общий лимит, строгий порядок внутри чата, отсев спама."""
+
+    def __init__(self, concurrency=UPDATE_CONCURRENCY, max_pending=UPDATE_MAX_PENDING, chat_queue_cap=UPDATE_CHAT_QUEUE_CAP):
+        super().__init__(max(max_pending, concurrency))
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.chat_queue_cap = chat_queue_cap
+        self._running = None
+        self._chats = {}
+        self.waiting = 0
+        self.active = 0
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    async def initialize(self):
+        self._running = asyncio.Semaphore(self.concurrency)
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    @staticmethod
+    def _chat_key(update):
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    @staticmethod
+    def _text(update):
+        if isinstance(update, Update) and update.message and update.message.text:
+            return update.message.text.strip()
+        return None
+
+    def _admit(self, chat_id, text):
+        chat = self._chats.setdefault(chat_id, {"lock": asyncio.Lock(), "pending": 0, "texts": {}})
+        if text is not None and chat["texts"].get(text):
+            self.coalesced += 1
+            logger.info(f"Coalesced repeated update in chat {chat_id}")
+            return None
+        if chat["pending"] >= self.chat_queue_cap:
+            self.dropped += 1
+            logger.warning(f"Chat {chat_id} queue full ({chat['pending']}), dropping update")
+            return None
+        chat["pending"] += 1
+        if text is not None:
+            chat["texts"][text] = chat["texts"].get(text, 0) + 1
+        return chat
+
+    def _release(self, chat_id, chat):
+        chat["pending"] -= 1
+        if chat["pending"] <= 0 and self._chats.get(chat_id) is chat:
+            del self._chats[chat_id]
+
+    def _unmark_waiting(self, chat, text):
+        if text is not None:
+            chat["texts"][text] -= 1
+            if not chat["texts"][text]:
+                del chat["texts"][text]
+
+    async def process_update(self, update, coroutine):
+        # Базовый семафор не берём: за ним отсев ниже срабатывал бы только после очереди, а до того
+        # апдейты копились бы ждущими задачами без предела. Объём ждущих ограничивает max_pending
+        await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        queued_at = time.monotonic()
+        if self.waiting >= self.max_pending:
+            self.rejected += 1
+            # Под перегрузкой не заваливаем лог строкой на каждый отброшенный апдейт
+            if self.rejected % 100 == 1:
+                logger.warning(f"Overloaded ({self.waiting} updates waiting), rejected {self.rejected} so far")
+            coroutine.close()
+            return
+        chat_id = self._chat_key(update)
+        if chat_id is None:
+            self.waiting += 1
+            await self._run(coroutine, queued_at)
+            return
+        text = self._text(update)
+        chat = self._admit(chat_id, text)
+        if chat is None:
+            coroutine.close()
+            return
+        self.waiting += 1
+        entered = False
+        try:
+            async with chat["lock"]:
+                entered = True
+                self._unmark_waiting(chat, text)
+                await self._run(coroutine, queued_at)
+        finally:
+            if not entered:
+                # Отменили, пока ждали очереди чата: до _run дело не дошло, счётчики возвращаем здесь
+                self._unmark_waiting(chat, text)
+                self.waiting -= 1
+                coroutine.close()
+            self._release(chat_id, chat)
+
+    async def _run(self, coroutine, queued_at):
+        try:
+            await self._running.acquire()
+        except BaseException:
+            coroutine.close()
+            raise
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - queued_at
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        self.active += 1
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            self.processed += 1
+            self._running.release()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "chats": len(self._chats),
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "wait_avg": self.wait_time_total / self.processed if self.processed else 0.0,
+            "wait_max": self.wait_time_max,
+        }
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from shared_state import shared_backend
+
+logger = logging.getLogger("MEMEZVUKACH")
+
+USER_HISTORY_SIZE = int(os.getenv("USER_HISTORY_SIZE", "20"))
+USER_STATE_MAX_USERS = int(os.getenv("USER_STATE_MAX_USERS", "100000"))
+USER_STATE_TTL = float(os.getenv("USER_STATE_TTL", str(30 * 24 * 3600)))
+USER_STATE_DB = os.getenv("USER_STATE_DB", os.path.join("meme_audios", "user_state.sqlite3"))
+USER_STATE_FLUSH_INTERVAL = float(os.getenv("USER_STATE_FLUSH_INTERVAL", "30"))
+USER_STATE_WRITE_BATCH = 1000
+
+
+def phrase_hash(phrase):
+    # 0 в кольце означает пустую ячейку
+    return int.from_bytes(hashlib.blake2b(phrase.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+
+class PhraseRing:
+    """Последние фразы юзера как кольцо 64-битных хэшей фиксированного размера."""
+
+    __slots__ = ("hashes", "head", "touched_at")
+
+    def __init__(self, size, hashes=None, head=0, touched_at=0.0):
+        self.hashes = hashes if hashes is not None else array("Q", bytes(8 * size))
+        self.head = head
+        self.touched_at = touched_at
+
+    def add(self, value):
+        self.hashes[self.head] = value
+        self.head = (self.head + 1) % len(self.hashes)
+
+    def clear(self):
+        for i in range(len(self.hashes)):
+            self.hashes[i] = 0
+        self.head = 0
+
+
+class UserStateStore:
+    """История фраз по юзерам: LRU/TTL в памяти поверх необязательной SQLite-базы."""
+
+    def __init__(self, history_size=USER_HISTORY_SIZE, max_users=USER_STATE_MAX_USERS,
+                 ttl=USER_STATE_TTL, db_path=USER_STATE_DB, backend=None):
+        self.history_size = history_size
+        self.max_users = max_users
+        self.ttl = ttl
+        # С общим бэкендом история живёт там: при другом числе воркеров юзер попадёт в другой процесс
+        self.backend = backend
+        self.db_path = db_path if backend is None else ""
+        self._rings = OrderedDict()
+        self._dirty = set()
+        self._evicted = {}
+        self._db = None
+        # К SQLite ходим только из потоков to_thread; соединение одно, поэтому под замком
+        self._db_lock = threading.Lock()
+        self._pending_writes = set()
+        self._last_flush = time.monotonic()
+        self.loads = 0
+        self.evictions = 0
+
+    def _connect(self):
+        if self._db is None and self.db_path:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS user_phrases "
+                "(user_id INTEGER PRIMARY KEY, ring BLOB NOT NULL, head INTEGER NOT NULL, touched_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS user_phrases_touched ON user_phrases (touched_at)")
+            self._db.commit()
+        return self._db
+
+    async def load(self, user_id):
+        # Историю подтягиваем заранее и не из цикла событий; дальше _ring берёт её из памяти
+        if user_id in self._rings or user_id in self._evicted:
+            return
+        if self._pending_writes:
+            # Кольцо юзера может быть в ещё не записанной пачке — иначе прочитаем старую строку
+            await asyncio.gather(*list(self._pending_writes), return_exceptions=True)
+        if self.backend is not None:
+            saved = await self.backend.get(f"user:{user_id}")
+            row = (bytes.fromhex(saved["ring"]), saved["head"], saved["touched_at"]) if saved else None
+        elif self.db_path:
+            row = await asyncio.to_thread(self._select, user_id)
+        else:
+            return
+        ring = self._ring_from_row(row)
+        if ring is not None and user_id not in self._rings:
+            self._rings[user_id] = ring
+            self._evict()
+
+    def _select(self, user_id):
+        with self._db_lock:
+            return self._connect().execute(
+                "SELECT ring, head, touched_at FROM user_phrases WHERE user_id = ?", (user_id,)
+            ).fetchone()
+
+    def _ring_from_row(self, row):
+        if row is None:
+            return None
+        hashes = array("Q")
+        hashes.frombytes(row[0])
+        if len(hashes) != self.history_size:
+            return None
+        self.loads += 1
+        return PhraseRing(self.history_size, hashes, row[1], row[2])
+
+    def _ring(self, user_id):
+        ring = self._rings.get(user_id)
+        if ring is None:
+            ring = self._evicted.pop(user_id, None)
+            if ring is not None:
+                self._dirty.add(user_id)
+            else:
+                # Сохранённое кольцо уже поднял load(); чего там не нашлось — того и нет
+                ring = PhraseRing(self.history_size)
+            self._rings[user_id] = ring
+            self._evict()
+        else:
+            self._rings.move_to_end(user_id)
+        now = time.time()
+        if ring.touched_at and now - ring.touched_at > self.ttl:
+            ring.clear()
+        ring.touched_at = now
+        return ring
+
+    def _evict(self):
+        while len(self._rings) > self.max_users:
+            user_id, ring = self._rings.popitem(last=False)
+            self.evictions += 1
+            if user_id in self._dirty:
+                # Пишем пачками, а не по коммиту на каждого вытесненного
+                self._dirty.discard(user_id)
+                self._evicted[user_id] = ring
+        if len(self._evicted) >= USER_STATE_WRITE_BATCH:
+            self.flush()
+
+    def _write(self, items):
+        # Пишем в фоне: снимок колец берётся сейчас, ждать бэкенд или диск цикл событий не должен
+        if self.backend is not None:
+            if not items:
+                return
+            task = asyncio.ensure_future(self.backend.set_many([
+                (f"user:{user_id}", {"ring": ring.hashes.tobytes().hex(), "head": ring.head, "touched_at": ring.touched_at})
+                for user_id, ring in items
+            ], self.ttl))
+        elif self.db_path:
+            rows = [(user_id, ring.hashes.tobytes(), ring.head, ring.touched_at) for user_id, ring in items]
+            task = asyncio.ensure_future(asyncio.to_thread(self._write_db, rows, time.time() - self.ttl))
+        else:
+            return
+        self._pending_writes.add(task)
+        task.add_done_callback(self._written)
+
+    def _write_db(self, rows, expired_before):
+        with self._db_lock:
+            db = self._connect()
+            if rows:
+                db.executemany(
+                    "INSERT OR REPLACE INTO user_phrases (user_id, ring, head, touched_at) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+            db.execute("DELETE FROM user_phrases WHERE touched_at < ?", (expired_before,))
+            db.commit()
+
+    def _written(self, task):
+        self._pending_writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"User state flush error: {task.exception()}")
+
+    def has_heard(self, user_id, phrase):
+        return phrase_hash(phrase) in self._ring(user_id).hashes
+
+    def unheard(self, user_id, phrases):
+        hashes = self._ring(user_id).hashes
+        return [phrase for phrase in phrases if phrase_hash(phrase) not in hashes]
+
+    def remember(self, user_id, phrase):
+        self._ring(user_id).add(phrase_hash(phrase))
+        self._dirty.add(user_id)
+        if time.monotonic() - self._last_flush > USER_STATE_FLUSH_INTERVAL:
+            self.flush()
+
+    def clear(self, user_id):
+        self._ring(user_id).clear()
+        self._dirty.add(user_id)
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        items = [(user_id, self._rings[user_id]) for user_id in self._dirty if user_id in self._rings]
+        items += list(self._evicted.items())
+        self._dirty.clear()
+        self._evicted.clear()
+        try:
+            self._write(items)
+        except Exception as e:
+            logger.error(f"User state flush error: {e}")
+
+    def stats(self):
+        return {
+            "users_in_memory": len(self._rings),
+            "dirty": len(self._dirty),
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+    async def close(self):
+        self.flush()
+        await asyncio.gather(*self._pending_writes, return_exceptions=True)
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+user_state = UserStateStore(backend=shared_backend)